@@ -0,0 +1,68 @@
+# Per-chunk memory overhead of the list-of-ints chunk layout vs the bytes-backed Chunk.
+# Run from repo root: python -m benchmarks.chunk_memory [synthetic_size]
+import os
+import sys
+import tempfile
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from png_image import PNGImage
+
+
+class ListChunk:
+    # old chunk layout: raw list, a list copy of the data and a list crc
+    def __init__(self, chunk: list[int]):
+        self.raw = chunk
+        self.length = int.from_bytes(chunk[0:4], byteorder="big")
+        self.name = "".join([chr(c) for c in chunk[4:8]])
+        self.data = {"raw": chunk[8:self.length + 8]}
+        self.crc = chunk[self.length + 8:self.length + 12]
+
+
+def load_list_chunks(path):
+    with open(path, "rb") as file:
+        content = [a for a in file.read()]
+    chunks, start_idx = [], 8
+    while start_idx < len(content):
+        end_idx = start_idx + 12 + int.from_bytes(content[start_idx: start_idx + 4], byteorder="big")
+        chunks.append(ListChunk(content[start_idx: end_idx]))
+        start_idx = end_idx
+    return chunks
+
+
+def load_png_chunks(path):
+    return PNGImage(path).chunks
+
+
+def measure(load, path):
+    tracemalloc.start()
+    chunks = load(path)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(chunks), current, peak
+
+
+def report(path):
+    file_size = os.path.getsize(path)
+    print(f"{path}: {file_size} bytes")
+    for label, load in (("list chunks", load_list_chunks), ("bytes chunks", load_png_chunks)):
+        count, current, peak = measure(load, path)
+        overhead = (current - file_size) / count
+        print(f"\t{label:13} chunks: {count:5}  retained: {current:12}  peak: {peak:12}  "
+              f"overhead/chunk: {overhead:12.0f}  bytes/file byte: {current / file_size:6.2f}")
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+    report("data/dices.png")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "synthetic.png")
+        noise = np.random.default_rng(0).integers(0, 256, (size, size, 3), dtype=np.uint8)
+        Image.fromarray(noise, "RGB").save(path)
+        report(path)
+
+
+if __name__ == '__main__':
+    main()
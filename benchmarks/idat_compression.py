@@ -0,0 +1,75 @@
+# Wall time and output size of PNGImage.encrypt / decrypt for each IDAT compression level and strategy,
+# decrypt compresses with one thread per cpu core unless the policy says otherwise.
+# Run from repo root: python -m benchmarks.idat_compression [image_size]
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+from PIL import Image
+
+from block_cipher import Hybrid
+from png_image import PNGImage
+from rsa import MyRSA
+
+encrypt_policies = [
+    ("stored", 0, zlib.Z_DEFAULT_STRATEGY),
+    ("fastest", 1, zlib.Z_DEFAULT_STRATEGY),
+    ("default", zlib.Z_DEFAULT_COMPRESSION, zlib.Z_DEFAULT_STRATEGY),
+    ("huffman", zlib.Z_DEFAULT_COMPRESSION, zlib.Z_HUFFMAN_ONLY),
+]
+decrypt_policies = [
+    ("fastest", 1, zlib.Z_DEFAULT_STRATEGY, None),
+    ("default", zlib.Z_DEFAULT_COMPRESSION, zlib.Z_DEFAULT_STRATEGY, None),
+    ("default/1", zlib.Z_DEFAULT_COMPRESSION, zlib.Z_DEFAULT_STRATEGY, 1),
+    ("filtered", zlib.Z_DEFAULT_COMPRESSION, zlib.Z_FILTERED, None),
+    ("rle", zlib.Z_DEFAULT_COMPRESSION, zlib.Z_RLE, None),
+    ("best", 9, zlib.Z_DEFAULT_STRATEGY, None),
+]
+
+
+def idat_size(png):
+    return sum(chunk.length for chunk in png.chunks if chunk.name == "IDAT")
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def report(path, rsa, tmp_dir):
+    png = PNGImage(path)
+    print(f"{path}: {os.path.getsize(path)} bytes, IDAT: {idat_size(png)} bytes")
+    # Hybrid keeps the cipher cost small, so the numbers are dominated by zlib
+    encrypted_path = os.path.join(tmp_dir, "encrypted.png")
+    for label, level, strategy in encrypt_policies:
+        png = PNGImage(path)
+        encrypt_time = timed(png.encrypt, rsa, Hybrid, level=level, strategy=strategy)
+        print(f"\tencrypt {label:9} time: {encrypt_time:8.3f}s  IDAT: {idat_size(png):12}")
+        if level == 0:
+            png.save_image(encrypted_path)
+    for label, level, strategy, threads in decrypt_policies:
+        png = PNGImage(encrypted_path)
+        decrypt_time = timed(png.decrypt, rsa, Hybrid, level=level, strategy=strategy, threads=threads)
+        print(f"\tdecrypt {label:9} time: {decrypt_time:8.3f}s  IDAT: {idat_size(png):12}")
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+    rsa = MyRSA(2048, generate_keys=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # smooth gradient with some noise, compresses like a photo rather than like random data
+        y, x = np.mgrid[0:size, 0:size]
+        noise = np.random.default_rng(0).integers(0, 8, (size, size, 3))
+        pixels = (np.stack([x, y, x + y], axis=-1) * 255 // (2 * size) + noise).astype(np.uint8)
+        path = os.path.join(tmp_dir, "synthetic.png")
+        Image.fromarray(pixels, "RGB").save(path)
+        report("data/dices.png", rsa, tmp_dir)
+        report(path, rsa, tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+# Block cipher throughput of MyRSA vs PyRSA (PyCryptodome) backends.
+# Run from repo root: python -m benchmarks.rsa_backends [num_bits] [data_size]
+import os
+import sys
+import time
+
+from block_cipher import ElectronicCodeBook, Counter, Hybrid
+from rsa import MyRSA, PyRSA
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    num_bits = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+    data = os.urandom(int(sys.argv[2]) if len(sys.argv) > 2 else 100_000)
+    print(f"key: {num_bits} bits, data: {len(data)} bytes")
+    for rsa_class in (MyRSA, PyRSA):
+        rsa = rsa_class(num_bits, generate_keys=True)
+        for block_cipher in (ElectronicCodeBook, Counter, Hybrid):
+            encrypted, encrypt_time = timed(block_cipher.encrypt, rsa, data)
+            decrypted, decrypt_time = timed(block_cipher.decrypt, rsa, encrypted)
+            assert decrypted == data
+            print(f"\t{rsa_class.__name__:6} {block_cipher.__name__:18} encrypt: {encrypt_time:8.3f}s  "
+                  f"decrypt: {decrypt_time:8.3f}s  size: {len(encrypted)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,105 +1,405 @@
 from rsa import MyRSA, PyRSA
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 import unittest
 from random import randint
 import abc
+import math
+import os
+import secrets
+
+
+class BlockLayout:
+    # sizes of one operation's input and output blocks, the last input block may be partial
+    def __init__(self, data_len, in_block_len, out_block_len):
+        self.data_len = data_len
+        self.in_block_len = in_block_len
+        self.out_block_len = out_block_len
+        self.num_blocks = math.ceil(data_len / in_block_len)
+
+    @property
+    def out_size(self):
+        # exact unless output blocks shrink (padding removal), then it is an upper bound
+        full_blocks, last_block_len = divmod(self.data_len, self.in_block_len)
+        if last_block_len and self.in_block_len != self.out_block_len:
+            last_block_len = self.out_block_len
+        return full_blocks * self.out_block_len + last_block_len
+
+    def batch(self, first_block_idx, num_blocks):
+        # layout of num_blocks consecutive blocks starting at first_block_idx
+        beg_idx = first_block_idx * self.in_block_len
+        end_idx = min(self.data_len, beg_idx + num_blocks * self.in_block_len)
+        return BlockLayout(end_idx - beg_idx, self.in_block_len, self.out_block_len)
 
 
 class BlockCipher(metaclass=abc.ABCMeta):
-    padding_len = 3  # must be >= 2
+    batch_size = 256  # max number of blocks sent to a worker process at once
+
+    @staticmethod
+    def encrypt(rsa, data, encrypt_func, padding=True, workers=1, progress=None):
+        # padded blocks hold rsa.block_size bytes of data (see encrypt_block of rsa classes)
+        layout = BlockLayout(len(data), rsa.block_size if padding else rsa.num_bytes, rsa.num_bytes)
+        return BlockCipher._run(rsa, data, layout, partial(BlockCipher._process_batch, encrypt_func), workers,
+                                progress)
 
     @staticmethod
-    def encrypt(rsa, data, encrypt_func, padding=True):
-        padding_len = BlockCipher.padding_len if padding else 0
-        beg_idx, end_idx = 0, rsa.num_bytes - padding_len
-        result = bytearray()
-        while beg_idx < len(data):
-            result += encrypt_func(rsa, data[beg_idx: end_idx])
-            beg_idx = end_idx
-            end_idx += rsa.num_bytes - padding_len
+    def decrypt(rsa, data, decrypt_func, workers=1, progress=None):
+        layout = BlockLayout(len(data), rsa.num_bytes, rsa.block_size)
+        return BlockCipher._run(rsa, data, layout, partial(BlockCipher._process_batch, decrypt_func), workers,
+                                progress)
+
+    @staticmethod
+    def _run(rsa, data, layout, batch_func, workers, progress=None, executor=None):
+        # batch_func(rsa, first_block_idx, layout, data, out) processes consecutive blocks writing them into out,
+        # returns number of bytes written
+        # workers: number of processes, None means one per cpu core
+        # progress(done_blocks, num_blocks) is called after every batch, exception raised by it aborts the operation
+        # executor: process pool shared by several runs, it is left running
+        workers = workers or os.cpu_count()
+        data = memoryview(data)
+        result = bytearray(layout.out_size)
+        out = memoryview(result)
+        batch_blocks = max(1, min(BlockCipher.batch_size, math.ceil(layout.num_blocks / workers)))
+        indices = range(0, layout.num_blocks, batch_blocks)
+        layouts = [layout.batch(idx, batch_blocks) for idx in indices]
+        offsets = [idx * layout.in_block_len for idx in indices]
+        result_len = 0
+        if workers == 1 or len(indices) < 2:
+            for idx, batch, offset in zip(indices, layouts, offsets):
+                result_len += batch_func(rsa, idx, batch, data[offset: offset + batch.data_len], out[result_len:])
+                BlockCipher._report(progress, idx + batch.num_blocks, layout.num_blocks)
+        else:
+            batches = (bytes(data[offset: offset + batch.data_len]) for batch, offset in zip(layouts, offsets))
+            own_executor = executor is None
+            if own_executor:
+                executor = ProcessPoolExecutor(min(workers, len(indices)))
+            try:
+                for idx, batch, batch_result in zip(indices, layouts, executor.map(
+                        BlockCipher._run_batch, [batch_func] * len(indices), [rsa] * len(indices), indices, layouts,
+                        batches)):
+                    out[result_len: result_len + len(batch_result)] = batch_result
+                    result_len += len(batch_result)
+                    BlockCipher._report(progress, idx + batch.num_blocks, layout.num_blocks)
+            finally:
+                if own_executor:
+                    executor.shutdown(cancel_futures=True)
+        out.release()
+        del result[result_len:]
         return result
 
     @staticmethod
-    def decrypt(rsa, data, decrypt_func):
-        beg_idx, end_idx = 0, rsa.num_bytes
-        result = bytearray()
-        while beg_idx < len(data):
-            result += decrypt_func(rsa, data[beg_idx: end_idx])
-            beg_idx = end_idx
-            end_idx += rsa.num_bytes
+    def _report(progress, done, total):
+        if progress is not None:
+            progress(done, total)
+
+    @staticmethod
+    def _run_batch(batch_func, rsa, first_block_idx, layout, data):
+        result = bytearray(layout.out_size)
+        with memoryview(result) as out:
+            result_len = batch_func(rsa, first_block_idx, layout, memoryview(data), out)
+        del result[result_len:]
         return result
 
+    @staticmethod
+    def _process_batch(func, rsa, first_block_idx, layout, data, out):
+        # func(rsa, block, out, block_idx) writes a single block into out and returns its length
+        result_len = 0
+        for block_idx, beg_idx in enumerate(range(0, len(data), layout.in_block_len), first_block_idx):
+            block = data[beg_idx: beg_idx + layout.in_block_len]
+            result_len += func(rsa, block, out[result_len: result_len + layout.out_block_len], block_idx)
+        return result_len
+
     @staticmethod
     @abc.abstractmethod
-    def _encrypt(rsa, data):
+    def _encrypt(rsa, data, out, block_idx):
         pass
 
     @staticmethod
     @abc.abstractmethod
-    def _decrypt(rsa, data):
+    def _decrypt(rsa, data, out, block_idx):
         pass
 
 
+class BlockStream:
+    # incremental version of BlockCipher.encrypt/decrypt: update() processes all whole blocks received so far,
+    # finalize() the last partial block, output is the same as of processing all data at once
+    def __init__(self, rsa, in_block_len, out_block_len, batch_func, workers=1):
+        self.rsa = rsa
+        self.in_block_len = in_block_len
+        self.out_block_len = out_block_len
+        self.batch_func = batch_func
+        self.workers = workers or os.cpu_count()
+        self.block_idx = 0
+        self._pending = bytearray()
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def update(self, data) -> bytes:
+        self._pending += data
+        whole_len = len(self._pending) - len(self._pending) % self.in_block_len
+        result = self._process(bytes(self._pending[:whole_len]))
+        del self._pending[:whole_len]
+        return result
+
+    def finalize(self) -> bytes:
+        result = self._process(bytes(self._pending))
+        self._pending.clear()
+        return result
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def _process(self, data):
+        if not data:
+            return b""
+        layout = BlockLayout(len(data), self.in_block_len, self.out_block_len)
+        if self.workers > 1 and self._executor is None:
+            # created once and reused by all updates
+            self._executor = ProcessPoolExecutor(self.workers)
+        batch_func = partial(BlockStream._shifted_batch, self.batch_func, self.block_idx)
+        self.block_idx += layout.num_blocks
+        return BlockCipher._run(self.rsa, data, layout, batch_func, self.workers, executor=self._executor)
+
+    @staticmethod
+    def _shifted_batch(batch_func, shift, rsa, first_block_idx, layout, data, out):
+        # block indices continue from previous updates
+        return batch_func(rsa, shift + first_block_idx, layout, data, out)
+
+
 class ElectronicCodeBook(BlockCipher):
     @staticmethod
-    def encrypt(rsa, data):
-        return super(ElectronicCodeBook, ElectronicCodeBook).encrypt(rsa, data, ElectronicCodeBook._encrypt)
+    def encrypt(rsa, data, workers=1, progress=None):
+        return super(ElectronicCodeBook, ElectronicCodeBook).encrypt(rsa, data, ElectronicCodeBook._encrypt,
+                                                                     workers=workers, progress=progress)
 
     @staticmethod
-    def decrypt(rsa, data):
-        return super(ElectronicCodeBook, ElectronicCodeBook).decrypt(rsa, data, ElectronicCodeBook._decrypt)
+    def decrypt(rsa, data, workers=1, progress=None):
+        return super(ElectronicCodeBook, ElectronicCodeBook).decrypt(rsa, data, ElectronicCodeBook._decrypt,
+                                                                     workers=workers, progress=progress)
 
     @staticmethod
-    def _encrypt(rsa, byte_array):
-        num_zeros = rsa.num_bytes - ElectronicCodeBook.padding_len - len(byte_array)
-        zeros = bytearray([0] * num_zeros)
-        num_zeros = bytearray(num_zeros.to_bytes(2, byteorder="big"))
-        byte_array = num_zeros + zeros + bytearray(byte_array)
+    def encryptor(rsa, workers=1):
+        return BlockStream(rsa, rsa.block_size, rsa.num_bytes,
+                           partial(BlockCipher._process_batch, ElectronicCodeBook._encrypt), workers)
 
-        return bytearray(rsa.encrypt(int.from_bytes(byte_array[0: rsa.num_bytes], byteorder="big"))
-                         .to_bytes(rsa.num_bytes, "big"))
+    @staticmethod
+    def decryptor(rsa, workers=1):
+        return BlockStream(rsa, rsa.num_bytes, rsa.block_size,
+                           partial(BlockCipher._process_batch, ElectronicCodeBook._decrypt), workers)
+
+    @staticmethod
+    def _encrypt(rsa, byte_array, out, block_idx=0):
+        out[:rsa.num_bytes] = rsa.encrypt_block(byte_array)
+        return rsa.num_bytes
 
     @staticmethod
-    def _decrypt(rsa, byte_array):
-        result = bytearray(rsa.decrypt(int.from_bytes(byte_array[0: rsa.num_bytes], byteorder="big"))
-                           .to_bytes(rsa.num_bytes, "big"))
+    def _decrypt(rsa, byte_array, out, block_idx=0):
+        result = rsa.decrypt_block(byte_array)
+        out[:len(result)] = result
+        return len(result)
+
+
+class CounterContext:
+    # state of a single counter mode operation, contexts share nothing so they can run concurrently
+    def __init__(self, rsa, nonce, counter=0):
+        self.rsa = rsa
+        self.nonce = nonce
+        self.counter = counter
+
+    def keystream(self, num_blocks) -> bytes:
+        num_bytes = self.rsa.num_bytes
+        counters = range(self.counter, self.counter + num_blocks)
+        self.counter += num_blocks
+        return b"".join(self.rsa.encrypt(self.nonce + ctr).to_bytes(num_bytes, "big") for ctr in counters)
 
-        num_zeros = int.from_bytes(result[ElectronicCodeBook.padding_len - 2:ElectronicCodeBook.padding_len],
-                                   byteorder="big")
-        return bytearray(result[ElectronicCodeBook.padding_len + num_zeros:])
+    def update(self, data) -> bytes:
+        # data is xor-ed with keystream of whole blocks, only the last update may end with a partial block
+        if not data:
+            return b""
+        keystream = self.keystream(math.ceil(len(data) / self.rsa.num_bytes))
+        result = int.from_bytes(data, "big") ^ int.from_bytes(keystream[:len(data)], "big")
+        return result.to_bytes(len(data), "big")
 
 
 class Counter(BlockCipher):
     nonce = 123456
-    counter = 0
 
     @staticmethod
-    def encrypt(rsa, data):
-        Counter.counter = 0
-        return super(Counter, Counter).encrypt(rsa, data, Counter._encrypt, padding=False)
+    def encrypt(rsa, data, workers=1, progress=None, nonce=None):
+        return Counter._xor(rsa, data, workers, progress, Counter.nonce if nonce is None else nonce)
 
     @staticmethod
-    def decrypt(rsa, data):
-        Counter.counter = 0
-        return super(Counter, Counter).decrypt(rsa, data, Counter._decrypt)
+    def decrypt(rsa, data, workers=1, progress=None, nonce=None):
+        return Counter._xor(rsa, data, workers, progress, Counter.nonce if nonce is None else nonce)
 
     @staticmethod
-    def _encrypt(rsa, byte_array):
-        enc_non_ctr = bytearray(rsa.encrypt(Counter.nonce + Counter.counter).to_bytes(rsa.num_bytes, "big"))
-        Counter.counter += 1
-        return bytearray(x ^ y for (x, y) in zip(enc_non_ctr, byte_array))
+    def encryptor(rsa, workers=1, nonce=None):
+        return BlockStream(rsa, rsa.num_bytes, rsa.num_bytes,
+                           partial(Counter._xor_batch, Counter.nonce if nonce is None else nonce), workers)
 
     @staticmethod
-    def _decrypt(rsa, byte_array):
-        enc_non_ctr = bytearray(rsa.encrypt(Counter.nonce + Counter.counter).to_bytes(rsa.num_bytes, "big"))
-        Counter.counter += 1
-        return bytearray(x ^ y for (x, y) in zip(enc_non_ctr, byte_array))
+    def decryptor(rsa, workers=1, nonce=None):
+        return Counter.encryptor(rsa, workers, nonce)
 
+    @staticmethod
+    def _xor(rsa, data, workers, progress, nonce):
+        layout = BlockLayout(len(data), rsa.num_bytes, rsa.num_bytes)
+        return BlockCipher._run(rsa, data, layout, partial(Counter._xor_batch, nonce), workers, progress)
+
+    @staticmethod
+    def _xor_batch(nonce, rsa, first_block_idx, layout, data, out):
+        # counter starts at the block index, so batches can be processed in any order
+        out[:len(data)] = CounterContext(rsa, nonce, first_block_idx).update(data)
+        return len(data)
+
+    @staticmethod
+    def _encrypt(rsa, byte_array, out, block_idx):
+        out[:len(byte_array)] = CounterContext(rsa, Counter.nonce, block_idx).update(byte_array)
+        return len(byte_array)
 
-class TestBlockCiphers(unittest.TestCase):
     @staticmethod
-    def _encrypt_decrypt(block_cipher, data, rsa=MyRSA(1024, generate_keys=True)):
-        enc = block_cipher.encrypt(rsa, bytearray(data))
-        dec = block_cipher.decrypt(rsa, enc)
+    def _decrypt(rsa, byte_array, out, block_idx):
+        out[:len(byte_array)] = CounterContext(rsa, Counter.nonce, block_idx).update(byte_array)
+        return len(byte_array)
+
+
+class Hybrid:
+    # rsa only encapsulates a random secret (RSA-KEM), the data itself is encrypted with AES-GCM keyed by its hash
+    # layout: encapsulated secret (rsa.num_bytes) + nonce + ciphertext + tag
+    nonce_len = 12
+    tag_len = 16
+    progress_step = 1 << 20  # bytes processed between progress reports
+
+    @staticmethod
+    def encrypt(rsa, data, workers=1, progress=None):
+        secret = secrets.randbelow(rsa.mod - 3) + 2
+        cipher = AES.new(Hybrid._derive_key(rsa, secret), AES.MODE_GCM, nonce=secrets.token_bytes(Hybrid.nonce_len))
+        header = rsa.encrypt(secret).to_bytes(rsa.num_bytes, "big") + cipher.nonce
+        result = bytearray(len(header) + len(data) + Hybrid.tag_len)
+        result[:len(header)] = header
+        Hybrid._apply(cipher.encrypt, memoryview(data), memoryview(result)[len(header):-Hybrid.tag_len], progress)
+        result[-Hybrid.tag_len:] = cipher.digest()
+        return result
+
+    @staticmethod
+    def decrypt(rsa, data, workers=1, progress=None):
+        data = memoryview(data)
+        nonce_end = rsa.num_bytes + Hybrid.nonce_len
+        secret = rsa.decrypt(int.from_bytes(data[:rsa.num_bytes], "big"))
+        cipher = AES.new(Hybrid._derive_key(rsa, secret), AES.MODE_GCM, nonce=data[rsa.num_bytes: nonce_end])
+        result = bytearray(len(data) - nonce_end - Hybrid.tag_len)
+        Hybrid._apply(cipher.decrypt, data[nonce_end: -Hybrid.tag_len], memoryview(result), progress)
+        # raises ValueError if the key is wrong or the data was modified
+        cipher.verify(data[-Hybrid.tag_len:])
+        return result
+
+    @staticmethod
+    def encryptor(rsa, workers=1):
+        return HybridEncryptStream(rsa)
+
+    @staticmethod
+    def decryptor(rsa, workers=1):
+        return HybridDecryptStream(rsa)
+
+    @staticmethod
+    def _apply(cipher_func, data, out, progress):
+        for beg_idx in range(0, len(data), Hybrid.progress_step):
+            end_idx = beg_idx + Hybrid.progress_step
+            cipher_func(data[beg_idx: end_idx], output=out[beg_idx: end_idx])
+            BlockCipher._report(progress, min(end_idx, len(data)), len(data))
+
+    @staticmethod
+    def _derive_key(rsa, secret):
+        return SHA256.new(secret.to_bytes(rsa.num_bytes, "big")).digest()
+
+
+class HybridEncryptStream:
+    # incremental Hybrid.encrypt, the header comes with the first update and the tag with finalize
+    def __init__(self, rsa):
+        secret = secrets.randbelow(rsa.mod - 3) + 2
+        self._cipher = AES.new(Hybrid._derive_key(rsa, secret), AES.MODE_GCM,
+                               nonce=secrets.token_bytes(Hybrid.nonce_len))
+        self._header = rsa.encrypt(secret).to_bytes(rsa.num_bytes, "big") + self._cipher.nonce
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def update(self, data) -> bytes:
+        result = self._header + self._cipher.encrypt(data)
+        self._header = b""
+        return result
+
+    def finalize(self) -> bytes:
+        result = self._header + self._cipher.digest()
+        self._header = b""
+        return result
+
+    def close(self):
+        pass
+
+
+class HybridDecryptStream:
+    # incremental Hybrid.decrypt, the last tag_len bytes received are always held back as they may be the tag
+    def __init__(self, rsa):
+        self.rsa = rsa
+        self._cipher = None
+        self._pending = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def update(self, data) -> bytes:
+        self._pending += data
+        if self._cipher is None:
+            nonce_end = self.rsa.num_bytes + Hybrid.nonce_len
+            if len(self._pending) < nonce_end:
+                return b""
+            secret = self.rsa.decrypt(int.from_bytes(self._pending[:self.rsa.num_bytes], "big"))
+            self._cipher = AES.new(Hybrid._derive_key(self.rsa, secret), AES.MODE_GCM,
+                                   nonce=bytes(self._pending[self.rsa.num_bytes: nonce_end]))
+            del self._pending[:nonce_end]
+        data_len = max(0, len(self._pending) - Hybrid.tag_len)
+        result = self._cipher.decrypt(bytes(self._pending[:data_len]))
+        del self._pending[:data_len]
+        return result
+
+    def finalize(self) -> bytes:
+        if self._cipher is None or len(self._pending) != Hybrid.tag_len:
+            raise ValueError("Ciphertext too short")
+        # raises ValueError if the key is wrong or the data was modified
+        self._cipher.verify(bytes(self._pending))
+        return b""
+
+    def close(self):
+        pass
+
+
+class TestBlockCiphers(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # generated here, not at class definition, so importing the module (e.g. in worker processes) stays cheap
+        cls.py_rsa = PyRSA(1024, generate_keys=True)
+        cls.my_rsa = MyRSA(1024, generate_keys=True)
+
+    def _encrypt_decrypt(self, block_cipher, data, rsa=None, workers=1):
+        rsa = rsa or self.my_rsa
+        enc = block_cipher.encrypt(rsa, bytearray(data), workers=workers)
+        dec = block_cipher.decrypt(rsa, enc, workers=workers)
         return dec
 
     def test_ecb_data_shorter_than_key(self):
@@ -118,6 +418,90 @@ class TestBlockCiphers(unittest.TestCase):
         arr = [randint(0, 255) for _ in range(1000)]
         self.assertEqual(self._encrypt_decrypt(Counter, arr), bytearray(arr))
 
+    def test_hybrid_data_shorter_than_key(self):
+        arr = [0, 2, 1, 0, 5]
+        self.assertEqual(self._encrypt_decrypt(Hybrid, arr), bytearray(arr))
+
+    def test_hybrid_data_longer_than_key(self):
+        arr = [randint(0, 255) for _ in range(1000)]
+        self.assertEqual(self._encrypt_decrypt(Hybrid, arr), bytearray(arr))
+
+    def test_hybrid_wrong_key(self):
+        enc = Hybrid.encrypt(MyRSA(1024, generate_keys=True), bytearray(100))
+        with self.assertRaises(ValueError):
+            Hybrid.decrypt(MyRSA(1024, generate_keys=True), enc)
+
+    def test_py_rsa_block_ciphers(self):
+        arr = [randint(0, 255) for _ in range(1000)]
+        for block_cipher in (ElectronicCodeBook, Counter, Hybrid):
+            self.assertEqual(self._encrypt_decrypt(block_cipher, arr, rsa=self.py_rsa), bytearray(arr))
+
+    def test_py_rsa_multiple_workers(self):
+        arr = [randint(0, 255) for _ in range(5000)]
+        self.assertEqual(self._encrypt_decrypt(ElectronicCodeBook, arr, rsa=self.py_rsa, workers=3), bytearray(arr))
+
+    def test_progress_and_abort(self):
+        rsa = MyRSA(1024, generate_keys=True)
+        arr = bytearray(randint(0, 255) for _ in range(5000))
+        for block_cipher in (ElectronicCodeBook, Counter, Hybrid):
+            reports = []
+            enc = block_cipher.encrypt(rsa, arr, progress=lambda done, total: reports.append((done, total)))
+            self.assertEqual(reports[-1][0], reports[-1][1])
+
+            def abort(done, total):
+                raise InterruptedError()
+            with self.assertRaises(InterruptedError):
+                block_cipher.decrypt(rsa, enc, progress=abort)
+
+    def test_ecb_multiple_workers(self):
+        arr = [randint(0, 255) for _ in range(5000)]
+        self.assertEqual(self._encrypt_decrypt(ElectronicCodeBook, arr, workers=3), bytearray(arr))
+
+    def test_ctr_multiple_workers_matches_single_worker(self):
+        rsa = MyRSA(1024, generate_keys=True)
+        arr = bytearray(randint(0, 255) for _ in range(5000))
+        enc = Counter.encrypt(rsa, arr, workers=3)
+        self.assertEqual(enc, Counter.encrypt(rsa, arr))
+        self.assertEqual(Counter.decrypt(rsa, enc, workers=3), arr)
+
+    def test_ctr_context_updates_match_single_call(self):
+        rsa = MyRSA(1024, generate_keys=True)
+        arr = bytearray(randint(0, 255) for _ in range(1000))
+        context = CounterContext(rsa, Counter.nonce)
+        split = 3 * rsa.num_bytes
+        self.assertEqual(context.update(arr[:split]) + context.update(arr[split:]), Counter.encrypt(rsa, arr))
+
+    def test_ctr_concurrent_operations(self):
+        rsa = MyRSA(1024, generate_keys=True)
+        arrays = [bytearray(randint(0, 255) for _ in range(2000)) for _ in range(4)]
+        with ThreadPoolExecutor(4) as executor:
+            encrypted = list(executor.map(lambda arr: Counter.encrypt(rsa, arr), arrays))
+        self.assertEqual(encrypted, [Counter.encrypt(rsa, arr) for arr in arrays])
+
+    @staticmethod
+    def _stream(stream, data, piece_len=77):
+        with stream:
+            pieces = [stream.update(data[idx: idx + piece_len]) for idx in range(0, len(data), piece_len)]
+            return b"".join(pieces) + stream.finalize()
+
+    def test_streams_match_single_call(self):
+        rsa = MyRSA(1024, generate_keys=True)
+        arr = bytearray(randint(0, 255) for _ in range(5000))
+        for block_cipher in (ElectronicCodeBook, Counter):
+            enc = self._stream(block_cipher.encryptor(rsa), arr)
+            self.assertEqual(enc, block_cipher.encrypt(rsa, arr))
+            self.assertEqual(self._stream(block_cipher.decryptor(rsa, workers=2), enc, piece_len=500), arr)
+
+    def test_hybrid_streams(self):
+        rsa = MyRSA(1024, generate_keys=True)
+        arr = bytearray(randint(0, 255) for _ in range(5000))
+        enc = bytearray(self._stream(Hybrid.encryptor(rsa), arr))
+        self.assertEqual(Hybrid.decrypt(rsa, enc), arr)
+        self.assertEqual(self._stream(Hybrid.decryptor(rsa), Hybrid.encrypt(rsa, arr), piece_len=5), arr)
+        enc[-1] ^= 1
+        with self.assertRaises(ValueError):
+            self._stream(Hybrid.decryptor(rsa), enc)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,10 @@
+import unittest
 import zlib
-from PIL.ExifTags import TAGS
-import struct
+from collections import namedtuple
+
+import numpy as np
+
+from exif import ExifReader
 
 
 class Chunk:
@@ -26,6 +30,7 @@ class Chunk:
         "PLTE": "palette: a list of colors",
         "IDAT": "image data",
         "IEND": "end of file",
+        "tRNS": "transparency",
         "sBIT": "significant bits: color-accuracy of the source data",
         "gAMA": "image gamma",
         "sRGB": "standard RGB colour space",
@@ -49,19 +54,74 @@ class Chunk:
         3: "Absolute colorimetric"
     }
 
-    def __init__(self, chunk: list[int]):
+    __slots__ = ("_raw", "_data", "name", "parse", "offset", "dirty", "color_type")
+
+    def __init__(self, chunk, parse=True, offset=None, color_type=None):
         self.raw = chunk
-        self.length = int.from_bytes(chunk[0:4], byteorder="big")
-        self.name = "".join([chr(c) for c in chunk[4:8]])
-        data_end_idx = self.length + 8
-        self.data = {"raw": chunk[8:data_end_idx]}
-        self.crc = chunk[data_end_idx:data_end_idx + 4]
+        self.name = bytes(self._raw[4:8]).decode("latin-1")
+        # if False only chunk header is parsed, data holds just the raw bytes
+        self.parse = parse
+        # IHDR color type of the image the chunk belongs to (if known), meaning of tRNS data depends on it
+        self.color_type = color_type
+        # position of the chunk in its source file, a clean chunk can be copied from there instead of from memory
+        self.offset = offset
+        self.dirty = offset is None
+
+    @property
+    def raw(self):
+        return self._raw
+
+    @raw.setter
+    def raw(self, chunk):
+        # whole chunk (length, name, data, crc) is kept in one immutable buffer, everything else is a view into it
+        self._raw = chunk if isinstance(chunk, (bytes, memoryview)) else bytes(chunk)
+        self._data = None
+        self.dirty = True
+
+    def detach(self):
+        # copies raw out of a shared buffer (e.g. a mapped file) without marking the chunk as modified
+        self._raw = bytes(self._raw)
+        self._data = None
+
+    @property
+    def length(self):
+        return int.from_bytes(self._raw[0:4], byteorder="big")
+
+    @property
+    def payload(self):
+        return memoryview(self._raw)[8:-4]
+
+    @property
+    def crc(self):
+        return bytes(self._raw[-4:])
+
+    @property
+    def data(self):
+        # chunk data is decoded on first access and memoized until raw changes
+        if self._data is None:
+            self._data = LazyData(raw=self.payload)
+            if self.parse:
+                self._parse_data()
+        return self._data
 
+    @staticmethod
+    def pack(name: str, *pieces) -> bytes:
+        # chunk data may be given in pieces, they are copied once into the packed chunk
+        name = name.encode("latin-1")
+        crc = zlib.crc32(name)
+        for piece in pieces:
+            crc = zlib.crc32(piece, crc)
+        length = sum(map(len, pieces))
+        return b"".join((length.to_bytes(4, "big"), name, *pieces, crc.to_bytes(4, "big")))
+
+    def _parse_data(self):
         match self.name:
             case "IHDR":
                 self._parse_ihdr_data()
             case "PLTE":
                 self._parse_plte_data()
+            case "tRNS":
+                self._parse_trns_data()
             case "sBIT":
                 self._parse_sbit_data()
             case "gAMA":
@@ -98,26 +158,55 @@ class Chunk:
         description = Chunk.chunks_description[self.name] if self.name in Chunk.chunks_description.keys() else ""
         result = f"Chunk: {self.name}  ({description})\n\tlength: {self.length}\n\tdata:\n"
         for key, value in self.data.items():
-            if hide_raw_data and key == "raw":
-                continue
+            if key == "raw":
+                if hide_raw_data:
+                    continue
+                value = list(value)
+            elif hide_raw_data and isinstance(value, bytes) and len(value) > 64:
+                value = f"<{len(value)} bytes>"
             result += f"\t\t{key}: {value}\n"
         result += f"\tcrc: {hex(int.from_bytes(self.crc, byteorder='big'))}\n"
         return result
 
     def calculate_crc(self):
-        return zlib.crc32(bytearray(self.raw[4:-4]))
+        return zlib.crc32(memoryview(self._raw)[4:-4])
 
     def update_crc(self):
-        self.crc = self.calculate_crc()
-        byte_crc = self.crc.to_bytes(4, byteorder="big")
-        self.raw = bytearray(self.raw[:-4]) + byte_crc
+        byte_crc = self.calculate_crc().to_bytes(4, byteorder="big")
+        self.raw = b"".join((self._raw[:-4], byte_crc))
 
     def decompress_data(self):
         if self.name != "IDAT":
             return
-        decompressed_data = zlib.decompress(bytearray(self.raw[8:-4]))
-        self.length = len(decompressed_data)
-        self.raw = bytearray(self.length.to_bytes(4, "big")) + bytearray(self.raw[4:8]) + decompressed_data + bytearray(self.raw[-4:])
+        pieces = [data for data, _ in Chunk.decompress_stream([self.payload])]
+        length = sum(map(len, pieces))
+        self.raw = b"".join((length.to_bytes(4, "big"), self._raw[4:8], *pieces, self._raw[-4:]))
+
+    # yields (data, consumed) for a zlib stream split into payloads (e.g. of consecutive IDAT chunks), data is never
+    # longer than window even for highly compressed input, consumed counts compressed bytes used up so far
+    @staticmethod
+    def decompress_stream(payloads, window=1 << 18):
+        decompressor = zlib.decompressobj()
+        consumed = 0
+        for payload in payloads:
+            payload = memoryview(payload)
+            for beg_idx in range(0, len(payload), window):
+                piece = payload[beg_idx: beg_idx + window]
+                piece_len = len(piece)
+                while True:
+                    data = decompressor.decompress(piece, window)
+                    piece = decompressor.unconsumed_tail
+                    if data:
+                        yield data, consumed + piece_len - len(piece)
+                    # output of exactly window bytes may leave more output pending inside the decompressor
+                    if not piece and len(data) < window:
+                        break
+                consumed += piece_len
+        data = decompressor.flush()
+        if data:
+            yield data, consumed
+        if not decompressor.eof:
+            raise zlib.error("incomplete compressed data")
 
     def _parse_ihdr_data(self):
         raw_data = self.data["raw"]
@@ -131,6 +220,23 @@ class Chunk:
 
     def _parse_plte_data(self):
         self.data["number of entries"] = self.length // 3
+        # (entries, 3) uint8 array of red, green, blue, a view of the chunk data
+        self.data["palette"] = np.frombuffer(self.data["raw"], np.uint8, count=self.length // 3 * 3).reshape(-1, 3)
+
+    def _parse_trns_data(self):
+        raw_data = self.data["raw"]
+        match self.color_type:
+            case 3:
+                # alpha of palette entries, entries past the end are opaque
+                self.data["alpha"] = np.frombuffer(raw_data, np.uint8)
+            case 0:
+                self.data["gray"] = int.from_bytes(raw_data[0:2], byteorder="big")
+            case 2:
+                self.data["red"] = int.from_bytes(raw_data[0:2], byteorder="big")
+                self.data["green"] = int.from_bytes(raw_data[2:4], byteorder="big")
+                self.data["blue"] = int.from_bytes(raw_data[4:6], byteorder="big")
+            case 4 | 6:
+                self.data["error"] = f"not allowed for {Chunk.color_types[self.color_type]}"
 
     def _parse_sbit_data(self):
         raw_data = self.data["raw"]
@@ -182,9 +288,9 @@ class Chunk:
         self.data["keyword"] = keyword
         self.data["compression_method"] = Chunk.compression_method[int.from_bytes(raw_data[idx:idx + 1], byteorder="big")]
         if decode:
-            self.data["text"] = zlib.decompress(bytearray(raw_data[idx + 1:])).decode("utf-8", "ignore")
+            self.data["text"] = Lazy(lambda: zlib.decompress(bytearray(raw_data[idx + 1:])).decode("utf-8", "ignore"))
         else:
-            self.data["text"] = zlib.decompress(bytearray(raw_data[idx + 1:]))
+            self.data["text"] = Lazy(lambda: zlib.decompress(bytearray(raw_data[idx + 1:])))
 
     def _parse_ztxt_data(self):
         self._parse_compressed_text_chunk()
@@ -210,7 +316,7 @@ class Chunk:
         if self.data["compression_flag"] == 0:
             self.data["text"] = bytearray(raw_data[idx:]).decode("utf-8", "ignore")
         else:
-            self.data["text"] = zlib.decompress(bytearray(raw_data[idx + 1:])).decode("utf-8", "ignore")
+            self.data["text"] = Lazy(lambda: zlib.decompress(bytearray(raw_data[idx:])).decode("utf-8", "ignore"))
 
     def _parse_time_data(self):
         raw_data = self.data["raw"]
@@ -247,113 +353,119 @@ class Chunk:
         self.data["blue_y"] = int.from_bytes(raw_data[28:32], byteorder="big") / 100000
 
     def _parse_hist_data(self):
-        raw_data = self.data["raw"]
-        hist = []
-        for i in range(0, self.length, 2):
-            hist.append(int.from_bytes(raw_data[i:i+2], byteorder="big"))
-        self.data["histogram"] = hist
+        # usage frequency of each palette entry
+        self.data["histogram"] = np.frombuffer(self.data["raw"], ">u2", count=self.length // 2)
 
     def _parse_splt_data(self):
         raw_data = self.data["raw"]
         name, idx = self._get_text(raw_data)
         self.data["palette name"] = name
         self.data["sample depth"] = int.from_bytes(raw_data[idx:idx + 1], byteorder="big")
-        entries_len = self.length - idx - 1
-        self.data["number of entries"] = entries_len // 10 if self.data["sample depth"] == 16 else entries_len // 6
+        # records of red, green, blue, alpha samples of sample depth and frequency
+        sample = ">u2" if self.data["sample depth"] == 16 else "u1"
+        dtype = np.dtype([("red", sample), ("green", sample), ("blue", sample), ("alpha", sample),
+                          ("frequency", ">u2")])
+        num_entries = max(0, (self.length - idx - 1) // dtype.itemsize)
+        self.data["number of entries"] = num_entries
+        self.data["entries"] = np.frombuffer(raw_data, dtype, count=num_entries, offset=min(idx + 1, self.length))
 
     def _parse_exif_data(self):
-        raw_data = self.data["raw"]
-        order_code = f"{chr(raw_data[0])}{chr(raw_data[1])}"
-
-        if order_code == "MM":
-            byteorder = "big"
-        elif order_code == "II":
-            byteorder = "little"
-        else:
-            self.data["error"] = "header: invalid byteorder"
+        try:
+            reader = ExifReader(self.data["raw"])
+        except ValueError as error:
+            self.data["error"] = str(error)
             return
+        for name, decode in reader.entries():
+            if name not in self.data:
+                self.data[name] = Lazy(decode)
+
+
+class Lazy:
+    # value of LazyData computed on first access
+    def __init__(self, func):
+        self.func = func
+
+
+class LazyData(dict):
+    # dict evaluating and memoizing Lazy values on access
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if isinstance(value, Lazy):
+            value = value.func()
+            super().__setitem__(key, value)
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class ChunkHeader(namedtuple("ChunkHeader", ["name", "length", "offset", "crc"])):
+    # chunk seen only by its header, payload was skipped (offset is the file position of the length field)
+    @property
+    def end(self):
+        return self.offset + 12 + self.length
+
+    def display(self, hide_raw_data=True):
+        print(self.to_sting(hide_raw_data=hide_raw_data))
+
+    def to_sting(self, hide_raw_data=True):
+        description = Chunk.chunks_description[self.name] if self.name in Chunk.chunks_description.keys() else ""
+        result = f"Chunk: {self.name}  ({description})\n\tlength: {self.length}\n\tdata:\n"
+        if not hide_raw_data:
+            result += "\t\traw: <skipped>\n"
+        result += f"\tcrc: {hex(int.from_bytes(self.crc, byteorder='big'))}\n"
+        return result
 
-        if int.from_bytes(raw_data[2:4], byteorder=byteorder) != 42:
-            self.data["error"] = "header: not a tiff"
-            return
 
-        offset = int.from_bytes(raw_data[4:8], byteorder=byteorder)
-        while offset != 0:
-            offset = self._parse_ifd(raw_data, offset, byteorder)
-
-    def _parse_ifd(self, data, offset, byteorder):
-        number_of_entries = int.from_bytes(data[offset: offset + 2], byteorder=byteorder)
-        offset += 2
-
-        for _ in range(number_of_entries):
-            tag_id = int.from_bytes(data[offset: offset + 2], byteorder=byteorder)
-            offset += 2
-            tag = TAGS[tag_id] if tag_id in TAGS.keys() else f"unknown tag: {hex(tag_id)}"
-            tag_type = int.from_bytes(data[offset: offset + 2], byteorder=byteorder)
-            offset += 2
-            count = int.from_bytes(data[offset: offset + 4], byteorder=byteorder)
-            offset += 4
-            data_value = int.from_bytes(data[offset: offset + 4], byteorder=byteorder)
-
-            # unsigned byte
-            if tag_type == 1:
-                if byteorder == "big":
-                    decoded_data = int.from_bytes(data[offset: offset + 1], byteorder=byteorder)
-                else:
-                    decoded_data = int.from_bytes(data[offset + 3: offset + 4], byteorder=byteorder)
-            # ascii string
-            elif tag_type == 2:
-                if count <= 4:
-                    decoded_data = data_value.to_bytes(byteorder=byteorder, length=4).decode("ascii")
-                else:
-                    decoded_data = "".join(chr(c) for c in data[data_value: data_value + count - 1])
-            # unsigned short
-            elif tag_type == 3:
-                if byteorder == "big":
-                    decoded_data = int.from_bytes(data[offset: offset + 2], byteorder=byteorder)
-                else:
-                    decoded_data = int.from_bytes(data[offset + 2: offset + 4], byteorder=byteorder)
-            # unsigned long
-            elif tag_type == 4:
-                decoded_data = int.from_bytes(data[offset: offset + 4], byteorder=byteorder)
-            # unsigned rational (fractal)
-            elif tag_type == 5:
-                numerator = int.from_bytes(data[data_value: data_value + 4], byteorder=byteorder)
-                denominator = int.from_bytes(data[data_value + 4: data_value + 8], byteorder=byteorder)
-                decoded_data = numerator / denominator
-            # signed byte / signed short / signed long
-            elif tag_type == 6:
-                if byteorder == "big":
-                    decoded_data = int.from_bytes(data[offset: offset + 1], byteorder=byteorder, signed=True)
-                else:
-                    decoded_data = int.from_bytes(data[offset + 3: offset + 4], byteorder=byteorder, signed=True)
-            # signed short
-            elif tag_type == 8:
-                if byteorder == "big":
-                    decoded_data = int.from_bytes(data[offset: offset + 2], byteorder=byteorder, signed=True)
-                else:
-                    decoded_data = int.from_bytes(data[offset + 2: offset + 4], byteorder=byteorder, signed=True)
-            # signed long
-            elif tag_type == 9:
-                decoded_data = int.from_bytes(data[offset: offset + 4], byteorder=byteorder, signed=True)
-            # signed rational
-            elif tag_type == 10:
-                numerator = int.from_bytes(data[data_value: data_value + 4], byteorder=byteorder, signed=True)
-                denominator = int.from_bytes(data[data_value + 4: data_value + 8], byteorder=byteorder, signed=True)
-                decoded_data = numerator / denominator
-            # single float
-            elif tag_type == 11:
-                decoded_data = struct.unpack("f", data[offset: offset + 4])
-            # double float
-            elif tag_type == 12:
-                decoded_data = struct.unpack("f", data[data_value: data_value + 8])
-            # undefined / other
-            else:
-                decoded_data = f"undefined format value: {tag_type}"
-
-            self.data[tag] = decoded_data
-            # skip data value
-            offset += 4
-
-        next_ifd_offset = int.from_bytes(data[offset: offset + 4], byteorder=byteorder)
-        return next_ifd_offset  # if next_ifd_offset != 0 else "end"
+class TestChunk(unittest.TestCase):
+    def test_palette_and_histogram(self):
+        colors = np.arange(15, dtype=np.uint8).reshape(5, 3)
+        data = Chunk(Chunk.pack("PLTE", colors.tobytes())).data
+        self.assertEqual(data["number of entries"], 5)
+        self.assertEqual(data["palette"].dtype, np.uint8)
+        self.assertTrue(np.array_equal(data["palette"], colors))
+        histogram = np.array([0, 1, 300, 65535, 7], ">u2")
+        data = Chunk(Chunk.pack("hIST", histogram.tobytes())).data
+        self.assertTrue(np.array_equal(data["histogram"], histogram))
+        self.assertEqual(data["histogram"].dtype, np.dtype(">u2"))
+
+    def test_suggested_palette(self):
+        for depth, sample in ((8, "u1"), (16, ">u2")):
+            entries = np.array([(1, 2, 3, 4, 500), (250, 251, 252, 253, 65535)],
+                               [(name, sample) for name in ("red", "green", "blue", "alpha")] + [("frequency", ">u2")])
+            data = Chunk(Chunk.pack("sPLT", b"name\0", bytes([depth]), entries.tobytes(), b"x")).data
+            self.assertEqual(data["palette name"], "name")
+            self.assertEqual(data["sample depth"], depth)
+            self.assertEqual(data["number of entries"], 2)  # trailing partial entry is ignored
+            self.assertEqual(data["entries"].tolist(), entries.tolist())
+            self.assertEqual(data["entries"]["red"].dtype, np.dtype(sample))
+        data = Chunk(Chunk.pack("sPLT", b"name")).data
+        self.assertEqual(len(data["entries"]), 0)
+
+    def test_transparency_by_color_type(self):
+        raw = Chunk.pack("tRNS", bytes([0, 5, 1, 6, 0, 7]))
+        data = Chunk(raw, color_type=3).data
+        self.assertEqual(data["alpha"].tolist(), [0, 5, 1, 6, 0, 7])
+        self.assertNotIn("red", data)
+        data = Chunk(raw, color_type=2).data
+        self.assertEqual((data["red"], data["green"], data["blue"]), (5, 262, 7))
+        self.assertNotIn("alpha", data)
+        data = Chunk(Chunk.pack("tRNS", bytes([1, 2])), color_type=0).data
+        self.assertEqual(data["gray"], 258)
+        self.assertNotIn("alpha", data)
+        self.assertIn("error", Chunk(raw, color_type=6).data)
+        # without color type the data can not be told apart
+        self.assertEqual(list(Chunk(raw).data), ["raw"])
+
+
+if __name__ == '__main__':
+    unittest.main()
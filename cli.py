@@ -0,0 +1,211 @@
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import contextlib
+import glob
+import io
+import os
+import sys
+import tempfile
+import unittest
+from png_image import PNGImage
+from block_cipher import ElectronicCodeBook, Counter, Hybrid
+from key_store import KeyStore
+
+
+class CLI:
+    # headless batch processing of PNG files with a pool of worker processes
+    BlockCiphers = {
+        "ElectronicCodeBook": ElectronicCodeBook,
+        "Counter": Counter,
+        "Hybrid": Hybrid,
+    }
+    commands = ["inspect", "anonymize", "encrypt", "decrypt", "fft", "spectrum"]
+    chunk_size = 16  # files sent to a worker process at once
+    _rsa = None  # key of a worker process, loaded once per process
+
+    @staticmethod
+    def parse_args(argv):
+        parser = argparse.ArgumentParser(prog="main.py", description="Batch processing of PNG images.")
+        parser.add_argument("command", choices=CLI.commands)
+        parser.add_argument("inputs", nargs="+", help="png files, directories or glob patterns")
+        parser.add_argument("-o", "--output", help="output directory (inspect prints to stdout if not given)")
+        parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+        parser.add_argument("-r", "--recursive", action="store_true", help="search directories recursively")
+        parser.add_argument("-k", "--key", help="name of key in key store (encrypt, decrypt)")
+        parser.add_argument("--key-dir", default="keys", help="key store directory")
+        parser.add_argument("-c", "--cipher", choices=list(CLI.BlockCiphers.keys()), default="Hybrid")
+        args = parser.parse_args(argv)
+        if args.command in ["encrypt", "decrypt"] and args.key is None:
+            parser.error(f"{args.command} requires --key")
+        if args.command != "inspect" and args.output is None:
+            parser.error(f"{args.command} requires --output")
+        return args
+
+    @staticmethod
+    def collect_inputs(inputs, recursive=False):
+        # (path, output name) pairs, output name is the path relative to its input root (the directory given or
+        # the part of a pattern before its first wildcard) without extension, so files of different
+        # subdirectories do not overwrite each other
+        named = {}
+        for pattern in inputs:
+            root = None
+            if os.path.isdir(pattern):
+                root = pattern
+                pattern = os.path.join(pattern, "**", "*.png") if recursive else os.path.join(pattern, "*.png")
+            if glob.has_magic(pattern):
+                if root is None:
+                    root = CLI._pattern_root(pattern)
+                paths = sorted(glob.glob(pattern, recursive=recursive))
+            else:
+                root, paths = os.path.dirname(pattern), [pattern]
+            for path in paths:
+                named.setdefault(path, os.path.splitext(os.path.relpath(path, root or os.curdir))[0])
+        return list(named.items())
+
+    @staticmethod
+    def _pattern_root(pattern):
+        parts = pattern.split(os.sep)
+        idx = next(idx for idx, part in enumerate(parts) if glob.has_magic(part))
+        root = os.sep.join(parts[:idx])
+        return root or (os.sep if pattern.startswith(os.sep) else os.curdir)
+
+    @staticmethod
+    def duplicate_names(named_inputs):
+        # output names shared by more than one input (e.g. the same file name in two input directories)
+        paths = {}
+        for path, name in named_inputs:
+            paths.setdefault(os.path.normcase(name), []).append(path)
+        return {name: paths for name, paths in paths.items() if len(paths) > 1}
+
+    @staticmethod
+    def run(argv):
+        args = CLI.parse_args(argv)
+        named_inputs = CLI.collect_inputs(args.inputs, args.recursive)
+        duplicates = CLI.duplicate_names(named_inputs) if args.output is not None else {}
+        if duplicates:
+            for name, paths in duplicates.items():
+                print(f"output {name} would be written by more than one input: {', '.join(paths)}", file=sys.stderr)
+            return 2
+        paths, names = [path for path, _ in named_inputs], [name for _, name in named_inputs]
+        if args.output is not None:
+            os.makedirs(args.output, exist_ok=True)
+        if args.command in ["encrypt", "decrypt"] and args.key not in KeyStore(args.key_dir):
+            print(f"no key named {args.key} in {args.key_dir}", file=sys.stderr)
+            return 2
+
+        failed = 0
+        tasks = ([args.command] * len(paths), paths, names, [args.output] * len(paths), [args.cipher] * len(paths))
+        with ProcessPoolExecutor(max(1, args.workers), initializer=CLI._init_worker,
+                                 initargs=(args.key_dir, args.key)) as executor:
+            for path, error, text in executor.map(CLI.process, *tasks, chunksize=CLI.chunk_size):
+                if error is not None:
+                    failed += 1
+                    print(f"{path}: {error}", file=sys.stderr)
+                elif text is not None:
+                    print(text)
+        print(f"processed {len(paths) - failed}/{len(paths)} files", file=sys.stderr)
+        return 1 if failed else 0
+
+    @staticmethod
+    def _init_worker(key_dir, key_name):
+        if key_name is not None:
+            CLI._rsa = KeyStore(key_dir).load(key_name)
+
+    @staticmethod
+    def process(command, path, name, out_dir, cipher_name):
+        # returns (path, error, text to print), outputs are named name + suffix in out_dir (name may have
+        # subdirectories)
+        out_file = os.path.join(out_dir, name + ".png") if out_dir is not None else None
+        try:
+            if out_dir is not None:
+                os.makedirs(os.path.dirname(out_file), exist_ok=True)
+            match command:
+                case "inspect":
+                    text = PNGImage.inspect(path)
+                    if out_dir is None:
+                        return path, None, f"{path}\n{text}"
+                    with open(os.path.join(out_dir, name + ".txt"), "w") as file:
+                        file.write(text)
+                case "anonymize":
+                    PNGImage.anonymize_file(path, out_file)
+                case "encrypt":
+                    # one deflate thread per file, worker processes already use every core
+                    png = PNGImage(path)
+                    png.encrypt(CLI._rsa, CLI.BlockCiphers[cipher_name], threads=1)
+                    png.save_image(out_file)
+                case "decrypt":
+                    png = PNGImage(path)
+                    png.decrypt(CLI._rsa, CLI.BlockCiphers[cipher_name], threads=1)
+                    png.save_image(out_file)
+                case "fft":
+                    # full resolution spectra of every file would stay in the worker's cache, never read again
+                    magnitude, phase = PNGImage(path).fft(cache=False)
+                    magnitude.save(os.path.join(out_dir, name + "_magnitude.png"))
+                    phase.save(os.path.join(out_dir, name + "_phase.png"))
+                case "spectrum":
+                    # file is mapped, not read, so memory use stays bounded for huge scans
+                    with PNGImage(path, use_mmap=True, headers_only=True) as png:
+                        png.power_spectrum().save(os.path.join(out_dir, name + "_spectrum.png"))
+        except Exception as error:
+            return path, f"{type(error).__name__}: {error}", None
+        return path, None, None
+
+
+class TestCLI(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp_dir.cleanup)
+        self.root = self._tmp_dir.name
+        files = ("in/x.png", "in/a/x.png", "in/a/y.png", "in/b/x.png", "in/b/c/z.png", "in/notes.txt", "in2/x.png")
+        for path in files:
+            path = os.path.join(self.root, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "wb").close()
+
+    def _names(self, inputs, recursive=False):
+        # output name of every input path, both relative to the test directory
+        named = CLI.collect_inputs([os.path.join(self.root, pattern) for pattern in inputs], recursive)
+        return {os.path.relpath(path, self.root): name.replace(os.sep, "/") for path, name in named}
+
+    def _path(self, path):
+        return path.replace("/", os.sep)
+
+    def test_directory(self):
+        self.assertEqual(self._names(["in"]), {self._path("in/x.png"): "x"})
+
+    def test_recursive_directory(self):
+        self.assertEqual(self._names(["in"], recursive=True), {
+            self._path("in/x.png"): "x", self._path("in/a/x.png"): "a/x", self._path("in/a/y.png"): "a/y",
+            self._path("in/b/x.png"): "b/x", self._path("in/b/c/z.png"): "b/c/z"})
+
+    def test_glob_pattern(self):
+        self.assertEqual(self._names(["in/*/x.png"]),
+                         {self._path("in/a/x.png"): "a/x", self._path("in/b/x.png"): "b/x"})
+        self.assertEqual(self._names(["in/**/z.png"], recursive=True), {self._path("in/b/c/z.png"): "b/c/z"})
+
+    def test_explicit_file(self):
+        self.assertEqual(self._names(["in/b/c/z.png"]), {self._path("in/b/c/z.png"): "z"})
+        # a file also found through a directory keeps its first name
+        self.assertEqual(self._names(["in", "in/x.png"]), {self._path("in/x.png"): "x"})
+
+    def test_duplicate_names(self):
+        named = CLI.collect_inputs([os.path.join(self.root, "in"), os.path.join(self.root, "in2")])
+        duplicates = CLI.duplicate_names(named)
+        self.assertEqual(list(duplicates), ["x"])
+        self.assertEqual(duplicates["x"], [os.path.join(self.root, "in", "x.png"),
+                                           os.path.join(self.root, "in2", "x.png")])
+        self.assertEqual(CLI.duplicate_names(CLI.collect_inputs([os.path.join(self.root, "in")], recursive=True)), {})
+        output = os.path.join(self.root, "out")
+        with contextlib.redirect_stderr(io.StringIO()) as errors:
+            self.assertEqual(CLI.run(["anonymize", os.path.join(self.root, "in"), os.path.join(self.root, "in2"),
+                                      "-o", output]), 2)
+        self.assertIn("in2", errors.getvalue())
+        self.assertFalse(os.path.exists(output))
+
+
+def main(argv=None):
+    return CLI.run(sys.argv[1:] if argv is None else argv)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
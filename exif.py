@@ -0,0 +1,174 @@
+from functools import partial
+import math
+import struct
+import unittest
+
+from PIL.ExifTags import TAGS, GPSTAGS
+
+
+class ExifReader:
+    # TIFF structured exif data (payload of eXIf chunk), IFD entries are located up front and their values decoded
+    # only when asked for, every offset is bounds checked and every IFD is visited at most once
+    # tag type: (struct format of one element, number of fields per element)
+    types = {
+        1: ("B", 1),  # unsigned byte
+        2: ("s", 1),  # ascii string
+        3: ("H", 1),  # unsigned short
+        4: ("L", 1),  # unsigned long
+        5: ("LL", 2),  # unsigned rational
+        6: ("b", 1),  # signed byte
+        7: ("s", 1),  # undefined
+        8: ("h", 1),  # signed short
+        9: ("l", 1),  # signed long
+        10: ("ll", 2),  # signed rational
+        11: ("f", 1),  # single float
+        12: ("d", 1),  # double float
+        13: ("L", 1),  # ifd offset
+    }
+    # pointer tag: (name of sub-IFD, tag names of its entries)
+    sub_ifds = {
+        0x8769: ("Exif", TAGS),
+        0x8825: ("GPS", GPSTAGS),
+        0xA005: ("Interop", TAGS),
+    }
+    max_ifds = 64
+    max_byte_tuple_len = 64  # longer byte arrays (e.g. MakerNote written as bytes) are returned as bytes
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        byteorder = {b"MM": ">", b"II": "<"}.get(bytes(self.data[0:2]))
+        if byteorder is None:
+            raise ValueError("header: invalid byteorder")
+        self._short = struct.Struct(byteorder + "H")
+        self._long = struct.Struct(byteorder + "L")
+        self._entry = struct.Struct(byteorder + "HHL")  # tag, type, count, then 4 bytes of value or its offset
+        self._elements = {tag_type: struct.Struct(byteorder + element) for tag_type, (element, _) in self.types.items()}
+        if len(self.data) < 8 or self._short.unpack_from(self.data, 2)[0] != 42:
+            raise ValueError("header: not a tiff")
+
+    def entries(self):
+        # yields (name, decode) for every entry, decode() returns its value, tags of IFD0 and its sub-IFDs are named
+        # like PIL.ExifTags, tags of following IFDs (thumbnail) get the IFD number appended, problems found while
+        # walking IFDs are reported as "error" entries
+        pending = [(self._long.unpack_from(self.data, 4)[0], "IFD0", TAGS, True)]
+        visited = set()
+        while pending:
+            offset, ifd_name, tag_names, chained = pending.pop(0)
+            if offset in visited:
+                yield "error", partial(str, f"{ifd_name}: loop in IFD offsets")
+                continue
+            if len(visited) >= self.max_ifds:
+                yield "error", partial(str, f"{ifd_name}: too many IFDs")
+                continue
+            visited.add(offset)
+            num_entries = self._read(self._short, offset)
+            if num_entries is None or offset + 2 + 12 * num_entries > len(self.data):
+                yield "error", partial(str, f"{ifd_name}: offset out of bounds")
+                continue
+
+            for entry_offset in range(offset + 2, offset + 2 + 12 * num_entries, 12):
+                tag_id, tag_type, count = self._entry.unpack_from(self.data, entry_offset)
+                if tag_id in self.sub_ifds and count == 1 and tag_type in (4, 13):
+                    sub_ifd_name, sub_tag_names = self.sub_ifds[tag_id]
+                    pending.append((self._long.unpack_from(self.data, entry_offset + 8)[0], sub_ifd_name,
+                                    sub_tag_names, False))
+                    continue
+                name = tag_names.get(tag_id, f"unknown tag: {hex(tag_id)}")
+                if ifd_name.startswith("IFD") and ifd_name != "IFD0":
+                    name = f"{name} ({ifd_name})"
+                yield name, partial(self._decode, tag_type, count, entry_offset + 8)
+
+            if chained:
+                next_offset = self._read(self._long, offset + 2 + 12 * num_entries)
+                if next_offset:
+                    pending.append((next_offset, f"IFD{int(ifd_name[3:]) + 1}", TAGS, True))
+
+    def _read(self, field, offset):
+        if offset + field.size > len(self.data):
+            return None
+        return field.unpack_from(self.data, offset)[0]
+
+    def _decode(self, tag_type, count, field_offset):
+        if tag_type not in self.types:
+            return f"undefined format value: {tag_type}"
+        element = self._elements[tag_type]
+        size = element.size * count
+        # values longer than 4 bytes are stored elsewhere, the field holds their offset
+        offset = field_offset if size <= 4 else self._long.unpack_from(self.data, field_offset)[0]
+        if offset + size > len(self.data):
+            return "invalid offset"
+        value = self.data[offset: offset + size]
+        if tag_type == 2:
+            return bytes(value).split(b"\0", 1)[0].decode("latin-1")
+        if tag_type == 7 or (tag_type == 1 and count > self.max_byte_tuple_len):
+            return bytes(value)
+        if self.types[tag_type][1] == 2:
+            values = [numerator / denominator if denominator else math.nan
+                      for numerator, denominator in element.iter_unpack(value)]
+        else:
+            values = [number for number, in element.iter_unpack(value)]
+        return values[0] if count == 1 else tuple(values)
+
+
+class TestExifReader(unittest.TestCase):
+    @staticmethod
+    def _tiff(byteorder, ifds):
+        # ifds: list of (entries, next ifd index or None), entries: (tag, type, count, value bytes), values longer
+        # than 4 bytes are placed after all IFDs, value of sub-IFD pointers is the index of the pointed IFD
+        ifd_offsets, offset = [], 8
+        for entries, _ in ifds:
+            ifd_offsets.append(offset)
+            offset += 2 + 12 * len(entries) + 4
+        data, extra = bytearray(struct.pack(byteorder + "2sHL", b"MM" if byteorder == ">" else b"II", 42, 8)), b""
+        for entries, next_idx in ifds:
+            data += struct.pack(byteorder + "H", len(entries))
+            for tag, tag_type, count, value in entries:
+                if isinstance(value, int):
+                    value = struct.pack(byteorder + "L", ifd_offsets[value])
+                if len(value) > 4:
+                    value, extra = struct.pack(byteorder + "L", offset + len(extra)), extra + value
+                data += struct.pack(byteorder + "HHL", tag, tag_type, count) + value.ljust(4, b"\0")
+            data += struct.pack(byteorder + "L", 0 if next_idx is None else ifd_offsets[next_idx])
+        return bytes(data + extra)
+
+    def _parse(self, data):
+        return {name: decode() for name, decode in ExifReader(data).entries()}
+
+    def test_types_and_sub_ifds(self):
+        for byteorder in (">", "<"):
+            data = self._tiff(byteorder, [
+                ([(0x010F, 2, 6, b"Canon\0"), (0x0112, 3, 1, struct.pack(byteorder + "H", 6)),
+                  (0x8769, 4, 1, 1), (0x8825, 4, 1, 2)], 3),
+                ([(0x829A, 5, 1, struct.pack(byteorder + "LL", 1, 250)),
+                  (0x9204, 10, 1, struct.pack(byteorder + "ll", -1, 3)),
+                  (0x9999, 12, 1, struct.pack(byteorder + "d", 2.5)), (0x927C, 7, 300, bytes(300))], None),
+                ([(0x0002, 5, 3, struct.pack(byteorder + "6L", 50, 1, 3, 1, 0, 1))], None),
+                ([(0x0103, 3, 2, struct.pack(byteorder + "2H", 6, 7))], None),
+            ])
+            values = self._parse(data)
+            self.assertEqual(values["Make"], "Canon")
+            self.assertEqual(values["Orientation"], 6)
+            self.assertEqual(values["ExposureTime"], 1 / 250)
+            self.assertEqual(values["ExposureBiasValue"], -1 / 3)
+            self.assertEqual(values["unknown tag: 0x9999"], 2.5)
+            self.assertEqual(values["MakerNote"], bytes(300))
+            self.assertEqual(values["GPSLatitude"], (50.0, 3.0, 0.0))
+            self.assertEqual(values["Compression (IFD1)"], (6, 7))
+
+    def test_malformed_offsets(self):
+        data = self._tiff(">", [([(0x8769, 4, 1, 0), (0x010F, 2, 100, b"x" * 100)], 0)])
+        data = data[:-50]  # value of Make is cut off
+        values = {}
+        for name, decode in ExifReader(data).entries():
+            values.setdefault(name, decode())
+        self.assertEqual(values["Make"], "invalid offset")
+        self.assertIn("loop", values["error"])
+        with self.assertRaises(ValueError):
+            ExifReader(b"XX*\0")
+        out_of_bounds = bytearray(data)
+        out_of_bounds[4:8] = struct.pack(">L", 1 << 30)
+        self.assertEqual(self._parse(out_of_bounds), {"error": "IFD0: offset out of bounds"})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+from collections import OrderedDict
+import math
+import os
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+
+class FFTEngine:
+    # magnitude and phase spectra (fft-shifted, scaled to uint8) of greyscale images, results are cached by
+    # content key so showing the same image again never recomputes
+    cache_size = 8
+    # tiled (welch) power spectra of images too big for a single transform
+    tile_size = 512
+    tile_overlap = 0.5  # fraction of tile size shared by neighbouring tiles
+    memory_budget = 256 << 20  # bytes of working memory per batch of tiles
+    tile_bytes_per_pixel = 24  # tile + its complex half spectrum + power spectra
+
+    def __init__(self, cache_size=None):
+        self.cache_size = cache_size or FFTEngine.cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    # key identifies image content (None disables caching), load_pixels() returns (height, width) array of a single
+    # channel or (channels, height, width) array transformed in one batch, it is only called on cache miss,
+    # with preview_size (width, height) pixels are downsampled to about that size before transforming
+    def spectrum(self, key, load_pixels, preview_size=None):
+        cache_key = None if key is None else (key, preview_size)
+        cached = self.cached(cache_key)
+        if cached is not None:
+            return cached
+        pixels = np.asarray(load_pixels(), dtype=np.float32)
+        if preview_size is not None:
+            pixels = FFTEngine.downsample(pixels, preview_size)
+        result = FFTEngine.transform(pixels)
+        self.store(cache_key, result)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def cached(self, cache_key):
+        if cache_key is None:
+            return None
+        with self._lock:
+            result = self._cache.get(cache_key)
+            if result is not None:
+                self._cache.move_to_end(cache_key)
+            return result
+
+    def store(self, cache_key, result):
+        if cache_key is None:
+            return
+        for array in result:
+            array.flags.writeable = False  # shared by every caller getting it from cache
+        with self._lock:
+            self._cache[cache_key] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    @staticmethod
+    def downsample(pixels, size):
+        # block mean by integer factor over the last two axes, result is at least size unless pixels are smaller
+        height, width = pixels.shape[-2:]
+        factor = min(width // size[0], height // size[1])
+        if factor <= 1:
+            return pixels
+        height, width = height // factor, width // factor
+        blocks = pixels[..., :height * factor, :width * factor]
+        blocks = blocks.reshape(pixels.shape[:-2] + (height, factor, width, factor))
+        return blocks.mean(axis=(-3, -1), dtype=np.float32)
+
+    @staticmethod
+    def transform(pixels):
+        # rfft2 computes only columns 0..w//2 of the spectrum, the rest follows from symmetry of real input:
+        # F[u, v] = conj(F[-u, -v]), so magnitude is mirrored and phase mirrored and negated,
+        # leading axes (e.g. channels) are transformed in the same call
+        width = pixels.shape[-1]
+        half = np.fft.rfft2(pixels)
+        magnitude = FFTEngine._mirror(np.abs(half, out=np.empty(half.shape, np.float32)), width, negate=False)
+        phase = np.arctan2(half.imag, half.real, out=np.empty(half.shape, np.float32))
+        del half
+        phase = FFTEngine._mirror(phase, width, negate=True)
+
+        # map phase from [-pi, pi] to [0, 255] in place
+        phase += math.pi
+        phase *= 255 / (2 * math.pi)
+        return FFTEngine.log_scale(magnitude), phase.astype(np.uint8)
+
+    @staticmethod
+    def log_scale(values):
+        # log scaled to [0, 255] in place, for displaying magnitude or power spectra, every 2-D slice of the last
+        # two axes is scaled by its own maximum
+        np.log1p(values, out=values)
+        max_values = values.max(axis=(-2, -1), keepdims=True, initial=0)
+        values *= np.divide(255, max_values, out=np.zeros_like(max_values), where=max_values > 0)
+        return values.astype(np.uint8)
+
+    # averaged power spectrum (fft-shifted, float32) of hann windowed overlapping tiles of a 2-D array, pixels can
+    # be a np.memmap as only one batch of tiles is read at a time, progress(done_tiles, num_tiles) after each batch
+    @staticmethod
+    def power_spectrum(pixels, tile_size=None, overlap=None, memory_budget=None, progress=None):
+        total, count = None, 0
+        tiles = FFTEngine._half_power_batches(pixels, tile_size, overlap, memory_budget)
+        for positions, num_tiles, half_power in tiles:
+            batch_total = half_power.sum(axis=0, dtype=np.float64)
+            total = batch_total if total is None else total + batch_total
+            count += len(positions)
+            if progress is not None:
+                progress(count, num_tiles)
+        tile_width = min(tile_size or FFTEngine.tile_size, pixels.shape[1])
+        return FFTEngine._mirror((total / count).astype(np.float32), tile_width, negate=False)
+
+    # yields (positions, power) for batches of tiles, positions: (row, col) of top left corners,
+    # power: fft-shifted power spectra of the tiles with shape (len(positions), tile height, tile width)
+    @staticmethod
+    def tile_spectra(pixels, tile_size=None, overlap=None, memory_budget=None):
+        tile_width = min(tile_size or FFTEngine.tile_size, pixels.shape[1])
+        for positions, _, half_power in FFTEngine._half_power_batches(pixels, tile_size, overlap, memory_budget):
+            yield positions, FFTEngine._mirror(half_power, tile_width, negate=False)
+
+    @staticmethod
+    def tile_positions(shape, tile_shape, step):
+        # tiles start every step pixels, the last row and column of tiles is aligned with the image edge
+        def starts(size, tile):
+            result = list(range(0, size - tile + 1, step))
+            if result[-1] != size - tile:
+                result.append(size - tile)
+            return result
+        return [(row, col) for row in starts(shape[0], tile_shape[0]) for col in starts(shape[1], tile_shape[1])]
+
+    @staticmethod
+    def _half_power_batches(pixels, tile_size, overlap, memory_budget):
+        # tiles are stacked into one (batch, height, width) array, so each batch is a single vectorized rfft2
+        tile_size = tile_size or FFTEngine.tile_size
+        overlap = FFTEngine.tile_overlap if overlap is None else overlap
+        memory_budget = memory_budget or FFTEngine.memory_budget
+        tile_shape = (min(tile_size, pixels.shape[0]), min(tile_size, pixels.shape[1]))
+        step = max(1, round(tile_size * (1 - overlap)))
+        positions = FFTEngine.tile_positions(pixels.shape, tile_shape, step)
+        tile_bytes = FFTEngine.tile_bytes_per_pixel * tile_shape[0] * tile_shape[1]
+        batch_len = max(1, min(len(positions), memory_budget // tile_bytes))
+        window = np.outer(np.hanning(tile_shape[0]), np.hanning(tile_shape[1])).astype(np.float32)
+        batch = np.empty((batch_len,) + tile_shape, np.float32)
+        for beg_idx in range(0, len(positions), batch_len):
+            batch_positions = positions[beg_idx: beg_idx + batch_len]
+            tiles = batch[:len(batch_positions)]
+            for tile, (row, col) in zip(tiles, batch_positions):
+                tile[:] = pixels[row: row + tile_shape[0], col: col + tile_shape[1]]
+            tiles *= window
+            half = np.fft.rfft2(tiles)
+            half_power = np.abs(half, out=np.empty(half.shape, np.float32))
+            del half
+            np.square(half_power, out=half_power)
+            yield batch_positions, len(positions), half_power
+
+    @staticmethod
+    def _mirror(half, width, negate):
+        # full fft-shifted spectrum from its first width // 2 + 1 columns, leading axes are batch axes
+        height, half_width = half.shape[-2:]
+        full = np.empty(half.shape[:-1] + (width,), np.float32)
+        full[..., :half_width] = half
+        mirrored_rows = np.roll(np.arange(height)[::-1], 1)  # row of -u
+        mirrored = full[..., half_width:]
+        mirrored[:] = half[..., mirrored_rows, 1: width - half_width + 1][..., ::-1]
+        if negate:
+            np.negative(mirrored, out=mirrored)
+        return np.fft.fftshift(full, axes=(-2, -1))
+
+
+class TestFFTEngine(unittest.TestCase):
+    @staticmethod
+    def _reference(pixels):
+        shifted = np.fft.fftshift(np.fft.fft2(pixels))
+        magnitude = np.log1p(np.abs(shifted))
+        magnitude *= 255 / magnitude.max()
+        phase = (np.angle(shifted) + math.pi) * 255 / (2 * math.pi)
+        return magnitude.astype(np.float32), phase.astype(np.float32)
+
+    def test_matches_full_fft(self):
+        rng = np.random.default_rng(0)
+        for shape in ((64, 64), (63, 64), (64, 63), (31, 17), (1, 8)):
+            pixels = rng.integers(0, 256, shape).astype(np.float32)
+            magnitude, phase = FFTEngine.transform(pixels)
+            reference_magnitude, reference_phase = self._reference(pixels)
+            self.assertTrue(np.all(np.abs(magnitude - reference_magnitude) <= 1))
+            # phase near +-pi may land on either end
+            phase_diff = np.abs(phase - reference_phase)
+            self.assertTrue(np.all((phase_diff <= 1) | (phase_diff >= 254)))
+
+    def test_channels_batched(self):
+        pixels = np.random.default_rng(0).integers(0, 256, (4, 30, 41)).astype(np.float32)
+        magnitude, phase = FFTEngine.transform(pixels)
+        self.assertEqual(magnitude.shape, pixels.shape)
+        for channel, channel_pixels in enumerate(pixels):
+            channel_magnitude, channel_phase = FFTEngine.transform(channel_pixels)
+            self.assertTrue(np.array_equal(magnitude[channel], channel_magnitude))
+            self.assertTrue(np.array_equal(phase[channel], channel_phase))
+
+    def test_cache(self):
+        engine = FFTEngine(cache_size=2)
+        loads = []
+
+        def load():
+            loads.append(1)
+            return np.arange(64 * 64, dtype=np.uint8).reshape(64, 64)
+        first = engine.spectrum("a", load)
+        self.assertIs(engine.spectrum("a", load), first)
+        engine.spectrum("a", load, preview_size=(16, 16))
+        engine.spectrum("b", load)
+        engine.spectrum("a", load, preview_size=(16, 16))
+        self.assertEqual(len(loads), 3)
+        engine.spectrum("a", load)
+        self.assertEqual(len(loads), 4)
+
+    def test_power_spectrum_single_tile(self):
+        pixels = np.random.default_rng(0).integers(0, 256, (32, 48)).astype(np.float32)
+        window = np.outer(np.hanning(32), np.hanning(48))
+        reference = np.abs(np.fft.fftshift(np.fft.fft2(pixels * window))) ** 2
+        power = FFTEngine.power_spectrum(pixels, tile_size=64)
+        self.assertTrue(np.allclose(power, reference, rtol=1e-3, atol=reference.max() * 1e-6))
+
+    def test_tiles_from_memmap_batched(self):
+        pixels = np.random.default_rng(0).integers(0, 256, (300, 200)).astype(np.uint8)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "pixels.npy")
+            np.save(path, pixels)
+            mapped = np.load(path, mmap_mode="r")
+            power = FFTEngine.power_spectrum(mapped, tile_size=64, overlap=0.5)
+            small_batches = FFTEngine.power_spectrum(mapped, tile_size=64, overlap=0.5, memory_budget=1)
+            self.assertTrue(np.allclose(power, small_batches, rtol=1e-5))
+            tiles = list(FFTEngine.tile_spectra(mapped, tile_size=64, overlap=0.5, memory_budget=1))
+            del mapped
+        positions = [position for batch_positions, _ in tiles for position in batch_positions]
+        self.assertEqual(positions, FFTEngine.tile_positions(pixels.shape, (64, 64), 32))
+        self.assertEqual(positions[-1], (236, 136))
+        mean = np.mean(np.concatenate([spectra for _, spectra in tiles]), axis=0)
+        self.assertTrue(np.allclose(mean, power, rtol=1e-4))
+
+    def test_preview_downsamples(self):
+        pixels = np.arange(3 * 400 * 300, dtype=np.float32).reshape(3, 400, 300)
+        self.assertEqual(FFTEngine.downsample(pixels, (100, 100)).shape, (3, 133, 100))
+        self.assertEqual(FFTEngine.downsample(pixels, (640, 720)).shape, (3, 400, 300))
+        self.assertEqual(FFTEngine.downsample(pixels[0], (150, 200))[0, 0], np.mean(pixels[0, :2, :2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
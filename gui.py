@@ -2,15 +2,28 @@ import tkinter as tk
 from tkinter import filedialog, ttk, messagebox
 import tkinter.scrolledtext as scrolled_text
 from png_image import PNGImage
-from block_cipher import ElectronicCodeBook, Counter
+from block_cipher import ElectronicCodeBook, Counter, Hybrid
 from PIL import Image, ImageTk
 from rsa import MyRSA, PyRSA
+from key_generator import KeyGenerator
+from key_store import KeyStore
+from task_runner import TaskRunner
 
 
 class GUI:
     BlockCiphers = {
         "ElectronicCodeBook": ElectronicCodeBook,
         "Counter": Counter,
+        "Hybrid (RSA + AES)": Hybrid,
+    }
+
+    FFTChannels = {
+        "Greyscale": None,
+        "Red": "R",
+        "Green": "G",
+        "Blue": "B",
+        "Alpha": "A",
+        "Luminance": "L",
     }
 
     RsaKeySize = {
@@ -27,13 +40,21 @@ class GUI:
         # current image #
         self.png = PNGImage("data/dices.png")
         self.rsa = None
+        self.key_generator = KeyGenerator()
+        self.key_store = KeyStore()
+        # key entries text last passed to self.rsa, so keys are parsed only when edited
+        self._key_entries = None
         image = self.get_photo_image()
         # block cipher
         self.block_cipher = tk.StringVar()
+        # name of key in key store
+        self.key_name = tk.StringVar()
         # rsa key_size
         self.rsa_size = tk.StringVar()
         # rsa selection
         self.rsa_selection = tk.IntVar()
+        # image channel shown by fft
+        self.fft_channel = tk.StringVar()
         # widgets #
         # label with file path
         self.file_label = tk.Label(
@@ -159,6 +180,45 @@ class GUI:
             fg="white",
             command=self.save_image,
         )
+        # button for saving keys to key store
+        self.save_keys_button = tk.Button(
+            self.window,
+            text="Save Keys",
+            bg="black",
+            fg="white",
+            command=self.save_keys,
+        )
+        # button for loading keys from key store
+        self.load_keys_button = tk.Button(
+            self.window,
+            text="Load Keys",
+            bg="black",
+            fg="white",
+            command=self.load_keys,
+        )
+        # button for cancelling running task
+        self.cancel_button = tk.Button(
+            self.window,
+            text="Cancel",
+            bg="black",
+            fg="white",
+            command=self.cancel_task,
+        )
+        # progress of running task
+        self.progress_bar = ttk.Progressbar(
+            self.window,
+            maximum=1.0,
+            mode="determinate",
+        )
+        # runs long operations (encrypt, decrypt, fft, key generation) without freezing the window
+        self.task_runner = TaskRunner(self.window, self._show_progress)
+        # key name combo_box (editable, new name saves new key)
+        self.key_name_cbox = ttk.Combobox(
+            self.window,
+            values=self.key_store.names,
+            font=("Helvetica", "12", "bold"),
+            textvariable=self.key_name,
+        )
         # block cipher combo_box
         self.block_cipher_cbox = ttk.Combobox(
             self.window,
@@ -177,6 +237,17 @@ class GUI:
             textvariable=self.rsa_size,
         )
         self.rsa_size_cbox.set(list(self.RsaKeySize.keys())[0])
+        self.rsa_size_cbox.bind("<<ComboboxSelected>>", lambda _: self.prefill_keys())
+        self.prefill_keys()
+        # fft channel combo_box (spectrum of greyscale image or of a single channel)
+        self.fft_channel_cbox = ttk.Combobox(
+            self.window,
+            state="readonly",
+            font=("Helvetica", "12", "bold"),
+            textvariable=self.fft_channel,
+        )
+        self.fft_channel_cbox.bind("<<ComboboxSelected>>", lambda _: self.fft_channel_selected())
+        self.update_fft_channels()
         # rsa selection radio buttons
         self.rsa_radio_buttons = [
             tk.Radiobutton(self.window, text="MyRSA", variable=self.rsa_selection, value=1, font=("Helvetica", "10", "bold")),
@@ -226,6 +297,12 @@ class GUI:
         self.block_cipher_cbox.grid(row=2, column=2, padx=10, pady=10, sticky="NSEW")
         self.image.grid(row=3, column=0, columnspan=4, padx=10)
         self.text_scroll.grid(row=3, column=4, columnspan=2, padx=10, sticky="NSEW")
+        self.save_keys_button.grid(row=4, column=4, padx=10, pady=10, sticky="W")
+        self.load_keys_button.grid(row=4, column=4, padx=10, pady=10, sticky="E")
+        self.key_name_cbox.grid(row=4, column=5, padx=10, pady=10, sticky="NSEW")
+        self.progress_bar.grid(row=5, column=0, columnspan=4, padx=10, pady=10, sticky="EW")
+        self.cancel_button.grid(row=5, column=4, padx=10, pady=10, sticky="W")
+        self.fft_channel_cbox.grid(row=5, column=5, padx=10, pady=10, sticky="NSEW")
 
         self.window.columnconfigure(0, weight=1)
         self.window.columnconfigure(1, weight=1)
@@ -235,6 +312,8 @@ class GUI:
         self.window.columnconfigure(5, weight=3)
         # main loop #
         self.window.mainloop()
+        self.task_runner.shutdown()
+        self.key_generator.shutdown()
 
     def get_photo_image(self):
         image = self.png.get_image()
@@ -242,6 +321,8 @@ class GUI:
         return ImageTk.PhotoImage(image)
 
     def anonymize_image(self):
+        if self._busy():
+            return
         self.png.anonymize("data/out.png")  # self.png.image_path
         self.png = PNGImage("data/out.png")  # self.png.image_path
         self.update_scroll_text()
@@ -258,7 +339,28 @@ class GUI:
         self.text_scroll.configure(state="disabled")
 
     def get_fft(self):
-        magnitude, phase = self.png.fft()
+        png, channel = self.png, self.FFTChannels[self.fft_channel.get()]
+        self._run_task(lambda progress: png.fft(preview_size=(640, 720), channel=channel), self._show_fft,
+                       self._fft_failed, cancellable=False)
+
+    def update_fft_channels(self):
+        names = {channel: name for name, channel in self.FFTChannels.items()}
+        self.fft_channel_cbox.configure(values=["Greyscale"] + [names[channel] for channel in self.png.channel_names()])
+        self.fft_channel_cbox.set("Greyscale")
+
+    def fft_channel_selected(self):
+        # spectra of all channels are cached together, so switching channels is instant
+        if self.fft_mag_image.winfo_ismapped():
+            self.get_fft()
+
+    @staticmethod
+    def _fft_failed(error):
+        if not isinstance(error, OSError):
+            raise error
+        messagebox.showinfo('Error', 'Image data can not be decoded (is it encrypted?)')
+
+    def _show_fft(self, images):
+        magnitude, phase = images
         magnitude.thumbnail((640, 720), Image.ANTIALIAS)
         phase.thumbnail((640, 720), Image.ANTIALIAS)
         magnitude = ImageTk.PhotoImage(magnitude)
@@ -287,11 +389,12 @@ class GUI:
 
     def browse_files(self):
         filename = tk.filedialog.askopenfilename(title="Select file", filetypes=[("image files", ".png")])
-        if filename == "":
+        if filename == "" or self._busy():
             return
         self.png = PNGImage(filename)
         self.update_image()
         self.update_scroll_text()
+        self.update_fft_channels()
         self.file_label.configure(text=f"File path: {filename}")
         self.display_image_chunks()
 
@@ -300,39 +403,113 @@ class GUI:
             return messagebox.showinfo('Error', 'Keys not generated')
         if not self._update_keys():
             return
-        self.png.encrypt(rsa=self.rsa, cipher_block=self.BlockCiphers[self.block_cipher.get()])
-        self.update_image()
+        rsa, cipher_block = self.rsa, self.BlockCiphers[self.block_cipher.get()]
+        self._run_task(lambda progress: self.png.encrypt(rsa, cipher_block, workers=None, progress=progress),
+                       lambda _: self.update_image())
 
     def decrypt(self):
         if not self.rsa:
             return messagebox.showinfo('Error', 'Keys not generated')
         if not self._update_keys():
             return
-        self.png.decrypt(rsa=self.rsa, cipher_block=self.BlockCiphers[self.block_cipher.get()])
-        self.update_image()
+        rsa, cipher_block = self.rsa, self.BlockCiphers[self.block_cipher.get()]
+        self._run_task(lambda progress: self.png.decrypt(rsa, cipher_block, workers=None, progress=progress),
+                       lambda _: self.update_image(), self._decrypt_failed)
+
+    @staticmethod
+    def _decrypt_failed(error):
+        if not isinstance(error, ValueError):
+            raise error
+        messagebox.showinfo('Error', 'Decryption failed, wrong key or block cipher')
+
+    def _run_task(self, job, on_done, on_error=None, cancellable=True):
+        # cancel button is disabled while running jobs which do not report progress (they can not be stopped)
+        if not self._busy():
+            self.cancel_button.configure(state=tk.NORMAL if cancellable else tk.DISABLED)
+            self.task_runner.run(job, on_done, on_error, cancellable=cancellable)
+
+    def _busy(self):
+        if self.task_runner.busy:
+            messagebox.showinfo('Error', 'Wait for the running task to finish or cancel it')
+        return self.task_runner.busy
+
+    def cancel_task(self):
+        self.task_runner.cancel()
+
+    def _show_progress(self, fraction):
+        # fraction is None for tasks not reporting progress
+        if fraction is None:
+            self.progress_bar.configure(mode="indeterminate")
+            self.progress_bar.step(0.05)
+        else:
+            self.progress_bar.configure(mode="determinate", value=fraction)
 
     def _update_keys(self):
+        entries = self.mod_entry.get(), self.pub_key_entry.get(), self.pvt_key_entry.get()
+        if entries == self._key_entries:
+            return True
+        # edited keys get a new object, the old one may be shared (e.g. cached by the key store)
+        rsa = type(self.rsa)(self.rsa.num_bytes * 8)
         try:
-            self.rsa.set_keys(int(self.mod_entry.get()), int(self.pub_key_entry.get()), int(self.pvt_key_entry.get()))
+            rsa.set_keys(*map(int, entries))
         except ValueError:
             messagebox.showinfo('Error', 'Some key is not an integer')
             return False
+        self.rsa = rsa
+        self._key_entries = entries
         return True
 
+    def _show_keys(self):
+        for entry in (self.mod_entry, self.pub_key_entry, self.pvt_key_entry):
+            entry.delete(0, tk.END)
+        self.mod_entry.insert(0, str(self.rsa.mod))
+        self.pub_key_entry.insert(0, str(self.rsa.pub_exp))
+        self.pvt_key_entry.insert(0, str(self.rsa.pvt_exp))
+        self._key_entries = self.mod_entry.get(), self.pub_key_entry.get(), self.pvt_key_entry.get()
+
+    def save_keys(self):
+        if not self.rsa:
+            return messagebox.showinfo('Error', 'Keys not generated')
+        if not self.key_name.get():
+            return messagebox.showinfo('Error', 'Key name not given')
+        if not self._update_keys() or self._busy():
+            return
+        self.key_store.save(self.key_name.get(), self.rsa)
+        self.key_name_cbox.configure(values=self.key_store.names)
+
+    def load_keys(self):
+        if self._busy():
+            return
+        if self.key_name.get() not in self.key_store:
+            return messagebox.showinfo('Error', 'No key with given name')
+        self.rsa = self.key_store.load(self.key_name.get())
+        self.rsa_selection.set(1 if isinstance(self.rsa, MyRSA) else 2)
+        self.rsa_size_cbox.set(str(self.rsa.num_bytes * 8))
+        self._show_keys()
+
     def generate_keys(self):
         num_bits = self.RsaKeySize[self.rsa_size.get()]
         match self.rsa_selection.get():
             case 1:
-                self.rsa = MyRSA(num_bits)
+                rsa = MyRSA(num_bits)
+                job = lambda progress: self.key_generator.generate(num_bits)
             case 2:
-                self.rsa = PyRSA(num_bits)
+                rsa = PyRSA(num_bits)
+                job = lambda progress: rsa.generate_keys(num_bits)
             case _:
                 return messagebox.showinfo('Error', 'RSA not selected')
 
-        self.rsa.set_keys(*self.rsa.generate_keys())
-        self.mod_entry.insert(0, str(self.rsa.mod))
-        self.pub_key_entry.insert(0, str(self.rsa.pub_exp))
-        self.pvt_key_entry.insert(0, str(self.rsa.pvt_exp))
+        def keys_generated(keys):
+            rsa.set_keys(*keys)
+            self.rsa = rsa
+            self._show_keys()
+        self._run_task(job, keys_generated, cancellable=False)
+
+    def prefill_keys(self):
+        # start generating keys of selected size in background
+        self.key_generator.prefill(self.RsaKeySize[self.rsa_size.get()])
 
     def save_image(self):
+        if self._busy():
+            return
         self.png.save_image("data/out.png")
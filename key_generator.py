@@ -0,0 +1,87 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+import threading
+import time
+import unittest
+from rsa import MyRSA
+
+
+class KeyGenerator:
+    # generates MyRSA keys (n, e, d, p, q), p and q are searched for in parallel processes,
+    # with pool_size > 0 keys for requested sizes are pregenerated in background so generate returns instantly
+    def __init__(self, pool_size=1, workers=2):
+        self.pool_size = pool_size
+        self.workers = workers
+        self._processes = {}  # background -> process pool, keys asked for now never queue behind pregenerated ones
+        self._background = ThreadPoolExecutor(1, thread_name_prefix="key_generator")
+        self._pool = {}  # number of bits -> deque of futures with pregenerated keys
+        self._lock = threading.Lock()
+
+    def prefill(self, number_of_bits):
+        with self._lock:
+            pool = self._pool.setdefault(number_of_bits, deque())
+            while len(pool) < self.pool_size:
+                pool.append(self._background.submit(self.generate_now, number_of_bits, background=True))
+
+    def generate(self, number_of_bits=1024):
+        # a pregenerated key is taken only if it is ready, one still queued (e.g. behind a bigger key) is left in
+        # the pool and the key is generated right away instead of waiting for it
+        with self._lock:
+            pool = self._pool.get(number_of_bits)
+            future = pool.popleft() if pool and pool[0].done() else None
+        keys = future.result() if future is not None else self.generate_now(number_of_bits)
+        if self.pool_size:
+            self.prefill(number_of_bits)
+        return keys
+
+    def generate_now(self, number_of_bits=1024, background=False):
+        if self.workers == 1:
+            return MyRSA.generate_keys(number_of_bits)
+        processes = self._get_processes(background)
+        p, q = processes.map(MyRSA.find_prime, [number_of_bits // 2] * 2)
+        while q == p:
+            q = processes.submit(MyRSA.find_prime, number_of_bits // 2).result()
+        return MyRSA.keys_from_primes(p, q)
+
+    def _get_processes(self, background):
+        with self._lock:
+            if background not in self._processes:
+                self._processes[background] = ProcessPoolExecutor(self.workers)
+            return self._processes[background]
+
+    def shutdown(self):
+        with self._lock:
+            for pool in self._pool.values():
+                for future in pool:
+                    future.cancel()
+            self._pool.clear()
+        self._background.shutdown(wait=False)
+        for processes in self._processes.values():
+            processes.shutdown(wait=False, cancel_futures=True)
+
+
+class TestKeyGenerator(unittest.TestCase):
+    def test_foreground_not_blocked_by_background(self):
+        generator = KeyGenerator(pool_size=1, workers=2)
+        self.addCleanup(generator.shutdown)
+        # both background processes are busy, as while a big key is pregenerated
+        busy = [generator._get_processes(background=True).submit(time.sleep, 5) for _ in range(2)]
+        start = time.monotonic()
+        keys = generator.generate(512)
+        self.assertLess(time.monotonic() - start, 4)
+        self.assertFalse(any(future.done() for future in busy))
+        mod, pub_exp, pvt_exp = keys[:3]
+        self.assertEqual(pow(pow(12345, pub_exp, mod), pvt_exp, mod), 12345)
+
+    def test_pooled_keys(self):
+        generator = KeyGenerator(pool_size=1, workers=1)
+        self.addCleanup(generator.shutdown)
+        generator.prefill(512)
+        pooled = generator._pool[512][0]
+        pooled.result()
+        self.assertEqual(generator.generate(512), pooled.result())
+        self.assertIsNot(generator._pool[512][0], pooled)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+from Crypto.PublicKey import RSA
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+from rsa import MyRSA, PyRSA
+
+
+class KeyStore:
+    # named RSA keys saved as PKCS#1 PEM files (with CRT parameters) and a json index:
+    # {name: {"type": "MyRSA" | "PyRSA", "bits": number_of_bits, "file": file_name}}
+    rsa_types = {
+        "MyRSA": MyRSA,
+        "PyRSA": PyRSA,
+    }
+    index_file = "index.json"
+
+    def __init__(self, directory="keys"):
+        self.directory = directory
+        self._loaded = {}  # name -> already constructed rsa object
+        self._index = self._read_index()
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.directory, KeyStore.index_file), "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def _write_index(self):
+        # unique temporary file moved over the index, so stores saving at the same time (e.g. GUI and CLI) never
+        # write into the same file
+        tmp_file = tempfile.NamedTemporaryFile("w", dir=self.directory, prefix=".index", suffix=".tmp", delete=False)
+        try:
+            with tmp_file:
+                json.dump(self._index, tmp_file, indent=4)
+            os.replace(tmp_file.name, os.path.join(self.directory, KeyStore.index_file))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_file.name)
+            raise
+
+    @property
+    def names(self):
+        return sorted(self._index.keys())
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def save(self, name: str, rsa):
+        os.makedirs(self.directory, exist_ok=True)
+        # factors are recovered from (n, e, d) by PyCryptodome if not known
+        crt = rsa.crt
+        components = rsa.keys + ((crt[0], crt[1]) if crt is not None else ())
+        key = RSA.construct(rsa_components=components)
+        file_name = hashlib.sha1(name.encode("utf-8")).hexdigest()[:16] + ".pem"
+        opener = lambda path, flags: os.open(path, flags, 0o600)  # private keys readable only by owner
+        with open(os.path.join(self.directory, file_name), "wb", opener=opener) as file:
+            file.write(key.export_key("PEM"))
+        self._index[name] = {"type": type(rsa).__name__, "bits": rsa.num_bytes * 8, "file": file_name}
+        self._write_index()
+        self._loaded[name] = rsa
+
+    def load(self, name: str):
+        # returns the same rsa object for repeated loads of the same name
+        if name in self._loaded:
+            return self._loaded[name]
+        if name not in self._index:
+            raise KeyError(f"no key named {name}")
+        entry = self._index[name]
+        with open(os.path.join(self.directory, entry["file"]), "rb") as file:
+            key = RSA.import_key(file.read())
+        rsa = KeyStore.rsa_types[entry["type"]](entry["bits"])
+        rsa.set_keys(key.n, key.e, key.d, key.p, key.q)
+        self._loaded[name] = rsa
+        return rsa
+
+    def delete(self, name: str):
+        entry = self._index.pop(name)
+        self._loaded.pop(name, None)
+        os.remove(os.path.join(self.directory, entry["file"]))
+        self._write_index()
+
+
+class TestKeyStore(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp_dir.cleanup)
+        self.directory = os.path.join(self._tmp_dir.name, "keys")
+
+    def test_save_load_delete(self):
+        keys = {"my": MyRSA(1024, generate_keys=True), "py": PyRSA(1024, generate_keys=True)}
+        store = KeyStore(self.directory)
+        for name, rsa in keys.items():
+            store.save(name, rsa)
+        # a new store reads everything from disk
+        store = KeyStore(self.directory)
+        self.assertEqual(store.names, ["my", "py"])
+        for name, rsa in keys.items():
+            loaded = store.load(name)
+            self.assertIs(type(loaded), type(rsa))
+            self.assertEqual(loaded.keys, rsa.keys)
+            self.assertEqual(loaded.num_bytes, rsa.num_bytes)
+            self.assertIsNotNone(loaded.crt)
+            self.assertEqual(loaded.crt, rsa.crt)
+            self.assertIs(store.load(name), loaded)
+        store.delete("my")
+        self.assertNotIn("my", store)
+        with self.assertRaises(KeyError):
+            store.load("my")
+        self.assertEqual(KeyStore(self.directory).names, ["py"])
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted([store._index["py"]["file"], "index.json"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,14 @@
-from gui import GUI
+import sys
+import cli
 
 
 def main():
+    # with arguments runs headless batch processing (see cli.py), otherwise the GUI
+    if len(sys.argv) > 1:
+        return cli.main(sys.argv[1:])
+    from gui import GUI  # imported here, so tkinter is not needed on headless machines
     gui = GUI()
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,127 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import os
+import threading
+import unittest
+import zlib
+
+
+class ParallelCompressor:
+    # drop-in for zlib.compressobj (compress/flush) compressing segments of the stream concurrently (like pigz):
+    # every segment is raw deflate primed with the last 32 KB of the previous one, ended by a sync flush so the
+    # segments can simply be concatenated, adler-32 of the whole stream is combined from the segments' checksums
+    segment_size = 1 << 18
+    dictionary_size = 1 << 15  # deflate window
+    adler_base = 65521
+    _executor = None  # threads shared by all compressors, zlib releases the gil while compressing
+    _executor_lock = threading.Lock()
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION, strategy=zlib.Z_DEFAULT_STRATEGY, threads=None):
+        self.level = level
+        self.strategy = strategy
+        self.threads = threads or os.cpu_count()  # max segments compressed at once
+        self._pending = bytearray()
+        self._dictionary = b""
+        self._futures = deque()
+        self._adler = 1
+        # standard zlib header for level, taken from zlib itself
+        self._header = zlib.compressobj(level, strategy=strategy).flush()[:2]
+
+    def compress(self, data) -> bytes:
+        self._pending += data
+        results = []
+        while len(self._pending) >= ParallelCompressor.segment_size:
+            segment = bytes(self._pending[:ParallelCompressor.segment_size])
+            del self._pending[:ParallelCompressor.segment_size]
+            results.append(self._submit(segment, zlib.Z_SYNC_FLUSH))
+        results.append(self._collect(max_pending=self.threads))
+        return b"".join(results)
+
+    def flush(self) -> bytes:
+        result = self._submit(bytes(self._pending), zlib.Z_FINISH)
+        self._pending.clear()
+        result += self._collect(max_pending=0)
+        return result + self._adler.to_bytes(4, "big")
+
+    def _submit(self, segment, mode) -> bytes:
+        # at most threads segments are in flight, output of the oldest ones is collected first if needed
+        result = self._collect(max_pending=self.threads - 1)
+        future = ParallelCompressor._shared_executor().submit(self._compress_segment, segment, self._dictionary, mode)
+        self._futures.append((future, len(segment)))
+        size = ParallelCompressor.dictionary_size
+        self._dictionary = (self._dictionary[-size:] + segment[-size:])[-size:]
+        return result
+
+    def _compress_segment(self, segment, dictionary, mode):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, strategy=self.strategy, zdict=dictionary)
+        return compressor.compress(segment) + compressor.flush(mode), zlib.adler32(segment)
+
+    def _collect(self, max_pending):
+        # output of finished segments in stream order, waits until at most max_pending segments are left
+        results = [self._header]
+        self._header = b""
+        while self._futures and (len(self._futures) > max_pending or self._futures[0][0].done()):
+            future, segment_len = self._futures.popleft()
+            compressed, adler = future.result()
+            self._adler = ParallelCompressor.adler32_combine(self._adler, adler, segment_len)
+            results.append(compressed)
+        return b"".join(results)
+
+    @staticmethod
+    def adler32_combine(adler1, adler2, len2):
+        # adler-32 of concatenated data from checksums of both parts and length of the second
+        base = ParallelCompressor.adler_base
+        sum1 = ((adler1 & 0xffff) + (adler2 & 0xffff) - 1) % base
+        sum2 = ((adler1 >> 16) + (adler2 >> 16) + len2 * ((adler1 & 0xffff) - 1)) % base
+        return sum2 << 16 | sum1
+
+    @staticmethod
+    def _shared_executor():
+        with ParallelCompressor._executor_lock:
+            if ParallelCompressor._executor is None:
+                ParallelCompressor._executor = ThreadPoolExecutor(os.cpu_count(), thread_name_prefix="deflate")
+            return ParallelCompressor._executor
+
+
+class TestParallelCompressor(unittest.TestCase):
+    data = bytes(range(256)) * 1000 + os.urandom(300_000) + bytes(700_000)
+
+    @staticmethod
+    def _compress(data, piece_len, **kwargs):
+        compressor = ParallelCompressor(**kwargs)
+        pieces = [compressor.compress(data[idx: idx + piece_len]) for idx in range(0, len(data), piece_len)]
+        return b"".join(pieces) + compressor.flush()
+
+    def test_valid_zlib_stream(self):
+        for piece_len in (1000, 100_000, len(self.data)):
+            self.assertEqual(zlib.decompress(self._compress(self.data, piece_len)), self.data)
+
+    def test_levels_and_strategies(self):
+        for level, strategy in ((1, zlib.Z_DEFAULT_STRATEGY), (9, zlib.Z_FILTERED), (6, zlib.Z_RLE)):
+            compressed = self._compress(self.data, 50_000, level=level, strategy=strategy, threads=2)
+            self.assertEqual(zlib.decompress(compressed), self.data)
+
+    def test_empty_stream(self):
+        self.assertEqual(zlib.decompress(self._compress(b"", 1)), b"")
+
+    def test_segments_in_flight_limited_by_threads(self):
+        in_flight = []
+
+        class Compressor(ParallelCompressor):
+            def _submit(self, segment, mode):
+                result = super()._submit(segment, mode)
+                in_flight.append(len(self._futures))
+                return result
+        compressor = Compressor(threads=2)
+        compressed = compressor.compress(self.data) + compressor.flush()
+        self.assertEqual(zlib.decompress(compressed), self.data)
+        self.assertEqual(max(in_flight), 2)
+
+    def test_adler32_combine(self):
+        first, second = os.urandom(1000), os.urandom(70_000)
+        combined = ParallelCompressor.adler32_combine(zlib.adler32(first), zlib.adler32(second), len(second))
+        self.assertEqual(combined, zlib.adler32(first + second))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,37 +1,174 @@
+import contextlib
+import hashlib
+import io
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
 import zlib
 
-from PIL import Image, ImageFile
+from PIL import Image, ImageFile, PngImagePlugin
 import numpy as np
-from chunks import Chunk
+from chunks import Chunk, ChunkHeader
+from fft_engine import FFTEngine
+from parallel_zlib import ParallelCompressor
+from scanlines import ScanlineDecoder
 from rsa import MyRSA
+from block_cipher import ElectronicCodeBook, Counter, Hybrid
 # ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 
 class PNGImage:
-    def __init__(self, image_path: str):
-        with open(image_path, "rb") as input_image:
-            content = [a for a in input_image.read()]
+    critical_chunks = ["IHDR", "IEND", "PLTE", "IDAT"]
+    pixel_chunks = ["IHDR", "PLTE", "tRNS", "IDAT"]  # chunks defining decoded pixels
+    fft_engine = FFTEngine()
+    copy_buffer_size = 1 << 20  # buffer for copying byte ranges if the os can not copy them itself
+    max_write_buffers = 1024  # buffers passed to a single vectored write (IOV_MAX on linux)
+    idat_window = 1 << 18  # decompressed IDAT bytes passed through the cipher at once
+    idat_chunk_size = 1 << 16  # payload size of IDAT chunks written by encrypt and decrypt
+    # zlib level of encrypted IDAT data, ciphertext is random so deflate only wastes time on it, stored blocks add
+    # just 5 bytes per 64 KB
+    encrypt_level = 0
+    # zlib level and strategy of decrypted (plain image) IDAT data
+    decrypt_level = zlib.Z_DEFAULT_COMPRESSION
+    decrypt_strategy = zlib.Z_DEFAULT_STRATEGY
+
+    def __init__(self, image_path: str, use_mmap=False, headers_only=False):
         self.image_path = image_path
-        self.header = content[0:8]
+        self._mmap = None
+        with open(image_path, "rb") as input_image:
+            stat = os.fstat(input_image.fileno())
+            # unchanged chunks are copied from the source file on save, as long as it is not modified meanwhile
+            self._source_stat = (stat.st_size, stat.st_mtime_ns)
+            if use_mmap:
+                # chunks keep memoryview slices into the mapping instead of copies
+                self._mmap = mmap.mmap(input_image.fileno(), 0, access=mmap.ACCESS_READ)
+                content = memoryview(self._mmap)
+            else:
+                content = memoryview(input_image.read())
+        self.header = list(content[0:8])
+        self._source_header = bytes(content[0:8])
         self.chunks = []
-        self._read_chunks(content[8:])
+        self._read_chunks(content[8:], parse=not headers_only)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._mmap is None:
+            return
+        # copy chunks out of the mapping, so they stay valid after it is closed
+        for chunk in self.chunks:
+            chunk.detach()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass  # views of chunk data handed out earlier still use the mapping, it is unmapped once they are gone
+        self._mmap = None
+
+    def _is_source_file(self, out_file: str) -> bool:
+        return os.path.exists(out_file) and os.path.samefile(out_file, self.image_path)
 
-    def _read_chunks(self, image: list[int]):
+    def _is_source_unchanged(self) -> bool:
+        try:
+            stat = os.stat(self.image_path)
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == self._source_stat
+
+    def _read_chunks(self, image, parse=True):
         start_idx, end_idx = 0, 0
+        color_type = None
         while end_idx < len(image):
             chunk_length = int.from_bytes(image[start_idx: start_idx + 4], byteorder="big")
             end_idx = start_idx + 12 + chunk_length  # 12 = length + name + crc (each 4 bytes)
-            self.chunks.append(Chunk(image[start_idx: end_idx]))
+            chunk = Chunk(image[start_idx: end_idx], parse, offset=8 + start_idx, color_type=color_type)
+            color_type = PNGImage._color_type(chunk, color_type)
+            self.chunks.append(chunk)
             start_idx = end_idx
 
+    @staticmethod
+    def _color_type(chunk, color_type):
+        # color type known after chunk (IHDR comes first and tells it)
+        if chunk.name == "IHDR" and chunk.length >= 10:
+            return chunk.payload[9]
+        return color_type
+
+    # yields chunks one by one from a path or a file object positioned at the png header,
+    # chunks named in skip are seeked over and yielded as ChunkHeader (payload is never read)
+    @staticmethod
+    def iter_chunks(source, skip=("IDAT",)):
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, "rb") as file:
+                yield from PNGImage.iter_chunks(file, skip)
+            return
+        yield from PNGImage._scan_chunks(source, lambda name: name in skip)
+
+    @staticmethod
+    def iter_chunk_headers(source):
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, "rb") as file:
+                yield from PNGImage.iter_chunk_headers(file)
+            return
+        yield from PNGImage._scan_chunks(source, lambda name: True)
+
+    @staticmethod
+    def _scan_chunks(file, skip):
+        start = file.tell()
+        file.seek(start + 8)  # png header
+        offset = start + 8
+        color_type = None
+        while True:
+            head = file.read(8)
+            if len(head) < 8:
+                return
+            length = int.from_bytes(head[0:4], byteorder="big")
+            name = head[4:8].decode("latin-1")
+            if skip(name):
+                file.seek(length, os.SEEK_CUR)
+                chunk = ChunkHeader(name, length, offset - start, file.read(4))
+            else:
+                chunk = Chunk(head + file.read(length + 4), offset=offset - start, color_type=color_type)
+                color_type = PNGImage._color_type(chunk, color_type)
+            offset += 12 + length
+            yield chunk
+            if name == "IEND":
+                return
+
+    # reads the file only up to the first chunk with given name
+    @staticmethod
+    def find_chunk(source, name: str):
+        for chunk in PNGImage.iter_chunks(source, skip=() if name == "IDAT" else ("IDAT",)):
+            if chunk.name == name:
+                return chunk
+        return None
+
+    # same as to_string, but streams the file and never reads IDAT payloads
+    @staticmethod
+    def inspect(source, hide_raw_data=True):
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, "rb") as file:
+                return PNGImage.inspect(file, hide_raw_data)
+        header = list(source.read(8))
+        source.seek(-8, os.SEEK_CUR)
+        return PNGImage._chunks_to_string(header, PNGImage.iter_chunks(source), hide_raw_data)
+
     def display_data(self, hide_raw_data=True):
         print(self.to_string(hide_raw_data=hide_raw_data))
 
     def to_string(self, hide_raw_data=True):
-        header_name = "".join([chr(c) for c in self.header[1:4]])
-        result = f"Header: {header_name}\n\t raw: {self.header}\n"
+        return self._chunks_to_string(self.header, self.chunks, hide_raw_data)
+
+    @staticmethod
+    def _chunks_to_string(header, chunks, hide_raw_data):
+        header_name = "".join([chr(c) for c in header[1:4]])
+        result = f"Header: {header_name}\n\t raw: {header}\n"
         result += "\n--------------------------------------------------------------------------------\n\n"
-        for chunk in self.chunks:
+        for chunk in chunks:
             result += chunk.to_sting(hide_raw_data)
             result += "\n--------------------------------------------------------------------------------\n\n"
         return result
@@ -44,85 +181,521 @@ class PNGImage:
         return Image.open(self.image_path)
 
     def save_image(self, out_file: str):
-        with open(out_file, "wb") as file:
-            file.write(bytearray(self.header))
-            for chunk in self.chunks:
-                file.write(bytearray(chunk.raw))
+        self._write_chunks(out_file, self.chunks)
 
     def anonymize(self, out_file: str):
-        critical_chunks = list(filter(lambda chunk: chunk.name in ["IHDR", "IEND", "PLTE", "IDAT"], self.chunks))
-        critical_chunks = list(map(lambda chunk: chunk.raw, critical_chunks))
-        with open(out_file, "wb") as file:
-            file.write(bytearray(self.header))
-            for chunk in critical_chunks:
-                file.write(bytearray(chunk))
-
-    def fft(self):
-        im = Image.open(self.image_path).convert("L")
-        np_im = np.asarray(im)
-
-        img_fft = np.fft.fft2(np_im)
-        shifted_fft = np.fft.fftshift(img_fft)
-        magnitude, phase = np.abs(shifted_fft), np.angle(shifted_fft)
-        magnitude = 20 * np.log(magnitude)
-        # phase = 255 * (phase - phase.min()) / (phase.max() - phase.min())
-        # magnitude = 255 * (magnitude - magnitude.min()) / (magnitude.max() - magnitude.min())
-
-        phase *= 255 / phase.max()
-        magnitude *= 255 / magnitude.max()
-        # phase = np.abs(phase)
-        magnitude = np.abs(magnitude)
-
-        magnitude = Image.fromarray(magnitude.astype(np.uint8), "L")
-        phase = Image.fromarray(phase.astype(np.uint8), "L")
-
-        return magnitude, phase
+        self._write_chunks(out_file, list(filter(lambda chunk: chunk.name in PNGImage.critical_chunks, self.chunks)))
+
+    # only modified chunks are written from memory, runs of unmodified chunks are copied from the source file
+    def _write_chunks(self, out_file: str, chunks):
+        same_file = self._is_source_file(out_file)
+        if same_file:
+            self.close()
+        incremental = not same_file and self._is_source_unchanged()
+        header = bytes(self.header)
+        parts = [[0, 8]] if incremental and header == self._source_header else [header]
+        for chunk in chunks:
+            if not incremental or chunk.dirty:
+                parts.append(chunk.raw)
+            elif isinstance(parts[-1], list) and parts[-1][1] == chunk.offset:
+                parts[-1][1] = chunk.offset + len(chunk.raw)
+            else:
+                parts.append([chunk.offset, chunk.offset + len(chunk.raw)])
+
+        # the source file is replaced instead of truncated, views still mapping it stay valid
+        if same_file:
+            destination = PNGImage._replacing_file(out_file, self.image_path)
+        else:
+            destination = open(out_file, "wb", buffering=0)
+        with destination as dst, \
+                (open(self.image_path, "rb", buffering=0) if incremental else contextlib.nullcontext()) as src:
+            buffers = []
+            for part in parts:
+                if isinstance(part, list):
+                    PNGImage._write_buffers(dst, buffers)
+                    buffers = []
+                    PNGImage._copy_range(src, dst, part[0], part[1] - part[0])
+                else:
+                    buffers.append(part)
+            PNGImage._write_buffers(dst, buffers)
+
+    # unbuffered temporary file next to out_file (with permissions of mode_file), moved over out_file when writing
+    # succeeds and removed when it fails
+    @staticmethod
+    @contextlib.contextmanager
+    def _replacing_file(out_file: str, mode_file: str):
+        tmp_file = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(out_file)), prefix=".",
+                                               suffix=".tmp", buffering=0, delete=False)
+        try:
+            with tmp_file:
+                shutil.copymode(mode_file, tmp_file.name)
+                yield tmp_file
+            os.replace(tmp_file.name, out_file)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_file.name)
+            raise
+
+    @staticmethod
+    def _write_buffers(dst, buffers):
+        # vectored write straight from the chunk buffers, nothing is concatenated
+        buffers = [memoryview(buffer).cast("B") for buffer in buffers if len(buffer) > 0]
+        idx = 0
+        while idx < len(buffers):
+            if hasattr(os, "writev"):
+                written = os.writev(dst.fileno(), buffers[idx: idx + PNGImage.max_write_buffers])
+            else:
+                written = dst.write(buffers[idx])
+            while idx < len(buffers) and written >= len(buffers[idx]):
+                written -= len(buffers[idx])
+                idx += 1
+            if written > 0:
+                buffers[idx] = buffers[idx][written:]
+
+    # same as anonymize, but works on the file directly: chunk headers are scanned, critical chunks are copied
+    # as byte ranges (by the kernel where possible) and everything else is skipped, no chunk is parsed
+    @staticmethod
+    def anonymize_file(image_path: str, out_file: str):
+        ranges = [[0, 8]]  # png header
+        for chunk in PNGImage.iter_chunk_headers(image_path):
+            if chunk.name not in PNGImage.critical_chunks:
+                continue
+            if ranges[-1][1] == chunk.offset:
+                ranges[-1][1] = chunk.end
+            else:
+                ranges.append([chunk.offset, chunk.end])
+        # written to a temporary file first, so out_file may be the source file
+        with open(image_path, "rb", buffering=0) as src, PNGImage._replacing_file(out_file, image_path) as dst:
+            for beg_idx, end_idx in ranges:
+                PNGImage._copy_range(src, dst, beg_idx, end_idx - beg_idx)
+
+    @staticmethod
+    def _copy_range(src, dst, offset: int, length: int):
+        # copies length bytes from offset of src to current position of dst (both unbuffered)
+        try:
+            while length > 0:
+                copied = PNGImage._kernel_copy(src, dst, offset, length)
+                if copied == 0:
+                    raise EOFError("unexpected end of file")
+                offset += copied
+                length -= copied
+            return
+        except (OSError, AttributeError):
+            pass  # not supported by the os or for these files, rest is copied through a buffer
+        buffer = memoryview(bytearray(min(length, PNGImage.copy_buffer_size)))
+        src.seek(offset)
+        while length > 0:
+            read = src.readinto(buffer[:min(length, len(buffer))])
+            if read == 0:
+                raise EOFError("unexpected end of file")
+            dst.write(buffer[:read])
+            length -= read
+
+    @staticmethod
+    def _kernel_copy(src, dst, offset: int, length: int) -> int:
+        # data never enters python, copy_file_range may even share blocks on filesystems supporting it
+        if hasattr(os, "copy_file_range"):
+            return os.copy_file_range(src.fileno(), dst.fileno(), length, offset)
+        return os.sendfile(dst.fileno(), src.fileno(), offset, length)
+
+    # with preview_size (width, height) spectra are computed from the image downsampled to about that size,
+    # channel (one of channel_names) selects spectrum of a single channel instead of the greyscale image,
+    # spectra of all channels are computed together, results are cached by content_hash, so repeated calls are instant,
+    # cache=False skips the cache (for images shown only once, e.g. in batch processing)
+    def fft(self, preview_size=None, channel=None, cache=True):
+        if channel is None:
+            key, load_pixels = "L", lambda: np.asarray(self._open_image().convert("L"))
+        else:
+            key, load_pixels = "channels", self.channel_pixels
+        key = (self.content_hash(), key) if cache else None
+        magnitude, phase = PNGImage.fft_engine.spectrum(key, load_pixels, preview_size)
+        if channel is not None:
+            channel_idx = self.channel_names().index(channel)
+            magnitude, phase = magnitude[channel_idx], phase[channel_idx]
+        return Image.fromarray(magnitude, "L"), Image.fromarray(phase, "L")
+
+    def channel_names(self):
+        # from IHDR color type, palette images have colors of the palette (with alpha if tRNS is present)
+        names = {0: "L", 2: "RGB", 3: "RGB", 4: "LA", 6: "RGBA"}[self.chunks[0].payload[9]]
+        if names == "RGB" and self.chunks[0].payload[9] == 3 and self._find_chunk("tRNS") is not None:
+            names += "A"
+        return list(names)
+
+    def channel_pixels(self):
+        # (channels, height, width) array in order of channel_names, palette indices are expanded using PLTE
+        image = self._open_image()
+        if image.mode == "P":
+            pixels = self._palette()[np.asarray(image)]
+        else:
+            pixels = np.asarray(image.convert("L") if image.mode == "1" else image)
+        if pixels.ndim == 2:
+            pixels = pixels[np.newaxis]
+        else:
+            pixels = np.moveaxis(pixels, -1, 0)
+        return np.ascontiguousarray(pixels, dtype=np.float32)
+
+    def _palette(self):
+        # (entries, 3) colors from PLTE, with alpha column from tRNS (entries past its end are opaque)
+        palette = self._parsed_data("PLTE")["palette"]
+        transparency = self._parsed_data("tRNS")
+        if transparency is None:
+            return palette
+        alpha = np.full(len(palette), 255, np.uint8)
+        alpha_values = transparency["alpha"][:len(palette)]
+        alpha[:len(alpha_values)] = alpha_values
+        return np.column_stack((palette, alpha))
+
+    def _find_chunk(self, name: str):
+        return next(filter(lambda chunk: chunk.name == name, self.chunks), None)
+
+    def _parsed_data(self, name: str):
+        # decoded data of the first chunk named name, also when the image was opened with headers_only
+        chunk = self._find_chunk(name)
+        if chunk is None:
+            return None
+        return chunk.data if chunk.parse else Chunk(chunk.raw, color_type=chunk.color_type).data
+
+    # averaged power spectrum of overlapping tiles (see FFTEngine.power_spectrum) as log scaled image, memory use
+    # is bounded by memory_budget plus one strip of scanlines, the greyscale image is kept in a memory mapped file
+    def power_spectrum(self, tile_size=None, overlap=None, memory_budget=None, progress=None):
+        cache_key = (self.content_hash(), "power", tile_size, overlap)
+        cached = PNGImage.fft_engine.cached(cache_key)
+        if cached is None:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                pixels = self.greyscale_memmap(os.path.join(tmp_dir, "pixels.npy"))
+                power = FFTEngine.power_spectrum(pixels, tile_size, overlap, memory_budget, progress)
+                del pixels
+            cached = (FFTEngine.log_scale(power),)
+            PNGImage.fft_engine.store(cache_key, cached)
+        return Image.fromarray(cached[0], "L")
+
+    # greyscale pixels (see ScanlineDecoder.greyscale) written to a .npy file and returned as read only np.memmap,
+    # scanlines are decoded in strips of strip_rows straight from the IDAT data, the image is never decoded whole
+    # (so there is no PIL pixel limit either)
+    def greyscale_memmap(self, path: str, strip_rows=256):
+        palette = self._parsed_data("PLTE")
+        decoder = ScanlineDecoder(self._find_chunk("IHDR").payload, None if palette is None else palette["palette"])
+        pixels = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(decoder.height, decoder.width))
+        payloads = (chunk.payload for chunk in self.chunks if chunk.name == "IDAT")
+        scanlines = (data for data, _ in Chunk.decompress_stream(payloads, PNGImage.idat_window))
+        decoder.fill_greyscale(pixels, scanlines, strip_rows)
+        pixels.flush()
+        del pixels
+        return np.load(path, mmap_mode="r")
+
+    def content_hash(self) -> str:
+        # changes with decoded pixels only, ancillary metadata does not matter
+        digest = hashlib.blake2b(digest_size=16)
+        for chunk in self.chunks:
+            if chunk.name in PNGImage.pixel_chunks:
+                digest.update(chunk.raw)
+        return digest.hexdigest()
+
+    def _open_image(self) -> Image:
+        # file is decoded directly unless chunks were modified in memory
+        if self._is_source_unchanged() and not any(chunk.dirty for chunk in self.chunks):
+            return Image.open(self.image_path)
+        return Image.open(io.BytesIO(b"".join([bytes(self.header)] + [chunk.raw for chunk in self.chunks])))
 
     def join_idat_chunks(self):
-        idats = list(filter(lambda chunk: chunk.name == "IDAT", self.chunks))
-        if len(idats) == 1:
+        idat_chunks = list(filter(lambda chunk: chunk.name == "IDAT", self.chunks))
+        if len(idat_chunks) < 2:
             return
-        new_idat_data, new_idat_len = bytearray(idats[0].raw[8:-4]), idats[0].length
-        for idat in idats[1:]:
-            new_idat_len += idat.length
-            new_idat_data += bytearray(idat.raw[8:-4])
-            self.chunks.remove(idat)
-        idats[0].raw = bytearray(new_idat_len.to_bytes(4, "big")) + bytearray("IDAT".encode("ascii")) + new_idat_data + bytearray("chuj".encode("ascii"))
-        idats[0].length = new_idat_len
-        idats[0].update_crc()
-
-    def encrypt(self, rsa, cipher_block):
-        self.join_idat_chunks()
-        idat_chunks = tuple(filter(lambda chunk_: chunk_.name == "IDAT", self.chunks))
-        for chunk in idat_chunks:
-            chunk.raw = self._encrypt_chunk_data(rsa, chunk, cipher_block)
-
-    def decrypt(self, rsa, cipher_block):
-        idat_chunks = list(filter(lambda chunk_: chunk_.name == "IDAT", self.chunks))
-        for chunk in idat_chunks:
-            chunk.raw = self._decrypt_chunk_data(rsa, chunk, cipher_block)
-
-    def _encrypt_chunk_data(self, rsa, chunk, cipher_block):
-        chunk.decompress_data()
-        result = cipher_block.encrypt(rsa, chunk.raw[8:-4])
-        compressed_result = bytearray(zlib.compress(result))
-        compressed_result1 = bytearray(zlib.compress(result[:chunk.length])[2:-4])
-        compressed_result2 = bytearray(zlib.compress(result[chunk.length:])[2:-4])
-        print(chunk.length)
-        print(len(result))
-        print(len(compressed_result))
-        chunk.length = len(compressed_result)
-        chunk.raw = bytearray(chunk.length.to_bytes(4, "big")) + bytearray(chunk.raw[4:8]) + compressed_result[:chunk.length] + bytearray(chunk.raw[-4:])
-        # chunk.raw = zlib.compress(result, 8)[2:-4]
-        # chunk.raw = bytearray(len(compressed_result1).to_bytes(4, "big")) + bytearray(chunk.raw[4:8]) + compressed_result1 + bytearray( chunk.raw[-4:])
-        # text_chunk = bytearray((len(compressed_result) - chunk.length).to_bytes(4, "big")) + bytearray("tEXt".encode("ascii")) + compressed_result[chunk.length:] + bytearray(chunk.raw[-4:])
-        chunk.update_crc()
-        return chunk.raw #+ text_chunk
-
-    def _decrypt_chunk_data(self, rsa, chunk, cipher_block):
-        chunk.decompress_data()
-        result = cipher_block.decrypt(rsa, chunk.raw[8:-4])
-        compressed_result = bytearray(zlib.compress(result))
-        chunk.raw = len(compressed_result).to_bytes(4, "big") + bytearray(chunk.raw[4:8]) + compressed_result + bytearray(chunk.raw[-4:])
-        chunk.update_crc()
-        return chunk.raw
+        self._replace_idat_chunks([Chunk(Chunk.pack("IDAT", *(chunk.payload for chunk in idat_chunks)))])
+
+    # inverse of join_idat_chunks, IDAT data is split into chunks of chunk_size bytes (the last may be shorter)
+    def split_idat_chunks(self, chunk_size=None):
+        idat_chunks = list(filter(lambda chunk: chunk.name == "IDAT", self.chunks))
+        chunk_size = chunk_size or PNGImage.idat_chunk_size
+        if not idat_chunks:
+            return
+        if all(chunk.length == chunk_size for chunk in idat_chunks[:-1]) and idat_chunks[-1].length <= chunk_size:
+            return
+        payloads = (chunk.payload for chunk in idat_chunks)
+        self._replace_idat_chunks(list(PNGImage._pack_idat_chunks(payloads, chunk_size)))
+
+    def _replace_idat_chunks(self, new_chunks):
+        # IDAT chunks are consecutive, new ones take the place of the first
+        first_idx = next(idx for idx, chunk in enumerate(self.chunks) if chunk.name == "IDAT")
+        other_chunks = list(filter(lambda chunk: chunk.name != "IDAT", self.chunks))
+        self.chunks = other_chunks[:first_idx] + new_chunks + other_chunks[first_idx:]
+
+    # level and strategy of the re-compressed IDAT data default to the class attributes,
+    # threads: number of threads compressing it, None means one per cpu core
+    def encrypt(self, rsa, cipher_block, workers=1, progress=None, chunk_size=None, level=None,
+                strategy=zlib.Z_DEFAULT_STRATEGY, threads=None):
+        level = PNGImage.encrypt_level if level is None else level
+        compressor = PNGImage._compressor(level, strategy, threads)
+        self._process_idat_stream(cipher_block.encryptor(rsa, workers), compressor, progress, chunk_size)
+
+    def decrypt(self, rsa, cipher_block, workers=1, progress=None, chunk_size=None, level=None, strategy=None,
+                threads=None):
+        level = PNGImage.decrypt_level if level is None else level
+        strategy = PNGImage.decrypt_strategy if strategy is None else strategy
+        compressor = PNGImage._compressor(level, strategy, threads)
+        self._process_idat_stream(cipher_block.decryptor(rsa, workers), compressor, progress, chunk_size)
+
+    @staticmethod
+    def _compressor(level, strategy, threads):
+        # stored blocks are cheap enough for a single thread
+        if threads == 1 or level == 0:
+            return zlib.compressobj(level, strategy=strategy)
+        return ParallelCompressor(level, strategy, threads)
+
+    # IDAT data flows decompressor -> cipher stream -> compressor in windows of idat_window bytes, so apart from
+    # the resulting chunks memory use does not grow with the image size
+    # progress(done, total) counts compressed input bytes, chunks stay unchanged if processing fails or is aborted
+    def _process_idat_stream(self, stream, compressor, progress, chunk_size):
+        idat_chunks = list(filter(lambda chunk: chunk.name == "IDAT", self.chunks))
+        total = sum(chunk.length for chunk in idat_chunks)
+
+        def compressed():
+            with stream:
+                payloads = (chunk.payload for chunk in idat_chunks)
+                for data, done in Chunk.decompress_stream(payloads, PNGImage.idat_window):
+                    yield compressor.compress(stream.update(data))
+                    if progress is not None:
+                        progress(done, total)
+                yield compressor.compress(stream.finalize())
+            yield compressor.flush()
+
+        new_chunks = list(PNGImage._pack_idat_chunks(compressed(), chunk_size or PNGImage.idat_chunk_size))
+        # last chance to abort (e.g. a cancel requested after the last window) before chunks are replaced
+        if progress is not None:
+            progress(total, total)
+        self._replace_idat_chunks(new_chunks)
+
+    # packs compressed data arriving in pieces of any size into IDAT chunks of chunk_size bytes (the last may be
+    # shorter), crc of a chunk is computed as soon as its data is complete, only chunks spanning pieces are buffered
+    @staticmethod
+    def _pack_idat_chunks(pieces, chunk_size):
+        pending = []
+        pending_len = 0
+        for piece in pieces:
+            piece = memoryview(piece)
+            if pending_len:
+                fill = piece[:chunk_size - pending_len]
+                pending.append(fill)
+                pending_len += len(fill)
+                piece = piece[len(fill):]
+                if pending_len < chunk_size:
+                    continue
+                yield Chunk(Chunk.pack("IDAT", *pending))
+                pending, pending_len = [], 0
+            full_len = len(piece) - len(piece) % chunk_size
+            for beg_idx in range(0, full_len, chunk_size):
+                yield Chunk(Chunk.pack("IDAT", piece[beg_idx: beg_idx + chunk_size]))
+            if full_len < len(piece):
+                pending.append(piece[full_len:])
+                pending_len += len(piece) - full_len
+        if pending_len:
+            yield Chunk(Chunk.pack("IDAT", *pending))
+
+
+class TestPNGImage(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # generated here, not at class definition, so importing the module (e.g. in worker processes) stays cheap
+        cls.rsa = MyRSA(1024, generate_keys=True)
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._tmp_dir.cleanup)
+        self.path = self._image("image.png")
+
+    def _image(self, name, size=(96, 64), mode="RGB", **save_args):
+        path = os.path.join(self._tmp_dir.name, name)
+        pixels = np.random.default_rng(0).integers(0, 256, (size[1], size[0], len(mode)), dtype=np.uint8)
+        Image.fromarray(pixels.squeeze(axis=2) if len(mode) == 1 else pixels, mode).save(path, **save_args)
+        return path
+
+    @staticmethod
+    def _pixels(path):
+        with Image.open(path) as image:
+            return np.asarray(image)
+
+    def test_scan_chunks_of_file_object(self):
+        info = PngImagePlugin.PngInfo()
+        info.add_text("Comment", "scanned")
+        path = self._image("text.png", size=(300, 200), pnginfo=info)
+        with open(path, "rb") as file:
+            content = file.read()
+        chunks = PNGImage(path).chunks
+        # png data preceded by other data, offsets are relative to the png header
+        source = io.BytesIO(b"prefix" + content)
+        source.seek(6)
+        scanned = list(PNGImage.iter_chunks(source))
+        self.assertEqual([chunk.name for chunk in scanned], [chunk.name for chunk in chunks])
+        for scanned_chunk, chunk in zip(scanned, chunks):
+            self.assertEqual(scanned_chunk.offset, chunk.offset)
+            self.assertEqual(scanned_chunk.crc, chunk.crc)
+            if chunk.name == "IDAT":
+                self.assertIsInstance(scanned_chunk, ChunkHeader)
+                self.assertEqual(content[scanned_chunk.offset: scanned_chunk.end], bytes(chunk.raw))
+            else:
+                self.assertEqual(bytes(scanned_chunk.raw), bytes(chunk.raw))
+        source.seek(6)
+        headers = list(PNGImage.iter_chunk_headers(source))
+        self.assertTrue(all(isinstance(header, ChunkHeader) for header in headers))
+        self.assertEqual([header.end for header in headers[:-1]], [header.offset for header in headers[1:]])
+        self.assertEqual(headers[-1].end, len(content))
+        source.seek(6)
+        self.assertEqual(PNGImage.find_chunk(source, "tEXt").data["keyword"], "Comment")
+        self.assertIsNone(PNGImage.find_chunk(path, "sPLT"))
+        idat_chunk = next(chunk for chunk in chunks if chunk.name == "IDAT")
+        self.assertEqual(bytes(PNGImage.find_chunk(path, "IDAT").raw), bytes(idat_chunk.raw))
+
+    def test_inspect_matches_to_string(self):
+        info = PngImagePlugin.PngInfo()
+        info.add_text("Comment", "inspected")
+        path = self._image("text.png", pnginfo=info)
+        self.assertEqual(PNGImage.inspect(path), PNGImage(path).to_string())
+        with open(path, "rb") as file:
+            self.assertEqual(PNGImage.inspect(file), PNGImage(path).to_string())
+
+    def test_palette_with_transparency(self):
+        path = os.path.join(self._tmp_dir.name, "palette.png")
+        image = Image.fromarray(np.arange(24, dtype=np.uint8).reshape(4, 6) % 6, "P")
+        image.putpalette(list(range(18)))
+        image.save(path, transparency=bytes([0, 128, 255]))
+        expected = np.column_stack((np.arange(18).reshape(6, 3), [0, 128, 255, 255, 255, 255]))
+        for headers_only in (False, True):
+            with PNGImage(path, use_mmap=True, headers_only=headers_only) as png:
+                self.assertTrue(np.array_equal(png._palette(), expected))
+                self.assertEqual(png.channel_names(), ["R", "G", "B", "A"])
+                with Image.open(path) as image:
+                    rgba = np.moveaxis(np.asarray(image.convert("RGBA")), -1, 0)
+                self.assertTrue(np.array_equal(png.channel_pixels(), rgba))
+        self.assertIn("alpha: [  0 128 255]", PNGImage.inspect(path))
+        # truecolor transparency is a color, not alpha
+        self._image("rgb.png", transparency=(1, 2, 3))
+        text = PNGImage(os.path.join(self._tmp_dir.name, "rgb.png")).to_string()
+        self.assertIn("red: 1", text)
+        self.assertNotIn("alpha", text)
+
+    def test_mmap_close_and_save_with_views(self):
+        png = PNGImage(self.path, use_mmap=True)
+        data = png.chunks[0].data
+        png.save_image(self.path)
+        self.assertEqual(data["raw"][0:4], png.chunks[0].payload[0:4])
+        self.assertTrue(np.array_equal(self._pixels(self.path), self._pixels(self._image("copy.png"))))
+        png = PNGImage(self.path, use_mmap=True)
+        payload = png.chunks[1].payload
+        png.close()
+        self.assertEqual(len(payload), png.chunks[1].length)
+        del payload, data
+
+    def test_save_copies_clean_chunks_and_writes_dirty_ones(self):
+        info = PngImagePlugin.PngInfo()
+        info.add_text("Author", "someone")
+        path = self._image("text.png", pnginfo=info)
+        out_file = os.path.join(self._tmp_dir.name, "out.png")
+        png = PNGImage(path, use_mmap=True)
+        png.save_image(out_file)
+        with open(path, "rb") as source, open(out_file, "rb") as out:
+            self.assertEqual(source.read(), out.read())
+        text_chunk = png._find_chunk("tEXt")
+        text_chunk.raw = Chunk.pack("tEXt", b"Author\0nobody at all")
+        self.assertTrue(text_chunk.dirty)
+        png.save_image(out_file)
+        png.close()
+        with open(out_file, "rb") as out:
+            self.assertEqual(out.read(), bytes(png.header) + b"".join(bytes(chunk.raw) for chunk in png.chunks))
+        self.assertEqual(bytes(PNGImage(out_file)._find_chunk("tEXt").payload), b"Author\0nobody at all")
+        self.assertTrue(np.array_equal(self._pixels(out_file), self._pixels(path)))
+
+    def test_encrypt_decrypt_restores_pixels(self):
+        for cipher_block in (ElectronicCodeBook, Counter, Hybrid):
+            png = PNGImage(self.path)
+            png.encrypt(self.rsa, cipher_block, chunk_size=1000, threads=2)
+            png.decrypt(self.rsa, cipher_block, level=9, threads=2)
+            out_file = os.path.join(self._tmp_dir.name, "out.png")
+            png.save_image(out_file)
+            self.assertTrue(np.array_equal(self._pixels(out_file), self._pixels(self.path)), cipher_block.__name__)
+
+    def test_idat_chunks_of_chunk_size(self):
+        png = PNGImage(self._image("big.png", size=(300, 200)))
+        png.encrypt(self.rsa, Counter, chunk_size=4096)
+        lengths = [chunk.length for chunk in png.chunks if chunk.name == "IDAT"]
+        self.assertGreater(len(lengths), 2)
+        self.assertTrue(all(length == 4096 for length in lengths[:-1]))
+        self.assertLessEqual(lengths[-1], 4096)
+        self.assertEqual([chunk.name for chunk in png.chunks], ["IHDR"] + ["IDAT"] * len(lengths) + ["IEND"])
+
+    def test_aborted_progress_leaves_chunks_unchanged(self):
+        PNGImage.idat_window, window = 1 << 12, PNGImage.idat_window
+        self.addCleanup(setattr, PNGImage, "idat_window", window)
+        png = PNGImage(self._image("big.png", size=(300, 200)))
+        chunks = list(png.chunks)
+        calls = []
+
+        def progress(done, total):
+            calls.append(done)
+            if len(calls) == 2:
+                raise KeyboardInterrupt()
+        with self.assertRaises(KeyboardInterrupt):
+            png.encrypt(self.rsa, Hybrid, progress=progress)
+        self.assertEqual(png.chunks, chunks)
+        self.assertFalse(any(chunk.dirty for chunk in png.chunks))
+        # the last window reports all data done, one more call is made after all data was processed, aborting
+        # there leaves chunks unchanged too
+        calls.clear()
+
+        def abort_at_end(done, total):
+            calls.append(done)
+            if calls.count(total) == 2:
+                raise KeyboardInterrupt()
+        with self.assertRaises(KeyboardInterrupt):
+            png.encrypt(self.rsa, Hybrid, progress=abort_at_end)
+        self.assertEqual(png.chunks, chunks)
+
+    def test_split_and_join_idat_chunks(self):
+        png = PNGImage(self._image("big.png", size=(300, 200)))
+        idat_data = b"".join(bytes(chunk.payload) for chunk in png.chunks if chunk.name == "IDAT")
+        png.split_idat_chunks(1000)
+        idat_chunks = [chunk for chunk in png.chunks if chunk.name == "IDAT"]
+        self.assertEqual(len(idat_chunks), -(-len(idat_data) // 1000))
+        self.assertEqual(b"".join(bytes(chunk.payload) for chunk in idat_chunks), idat_data)
+        self.assertTrue(all(int.from_bytes(chunk.crc, "big") == chunk.calculate_crc() for chunk in idat_chunks))
+        png.join_idat_chunks()
+        idat_chunks = [chunk for chunk in png.chunks if chunk.name == "IDAT"]
+        self.assertEqual(len(idat_chunks), 1)
+        self.assertEqual(bytes(idat_chunks[0].payload), idat_data)
+        out_file = os.path.join(self._tmp_dir.name, "out.png")
+        png.save_image(out_file)
+        self.assertTrue(np.array_equal(self._pixels(out_file), self._pixels(png.image_path)))
+
+    def test_power_spectrum_streams_image_larger_than_budget(self):
+        PNGImage.fft_engine.clear()
+        self.addCleanup(PNGImage.fft_engine.clear)
+        path = self._image("big.png", size=(300, 200))
+        with Image.open(path) as image:
+            grey = np.asarray(image.convert("L"))
+        expected = FFTEngine.log_scale(FFTEngine.power_spectrum(grey, tile_size=64))
+        # pixels exceed both the memory budget and PIL's pixel limit, which must not matter as PIL never sees them
+        max_pixels = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = 1000
+        self.addCleanup(setattr, Image, "MAX_IMAGE_PIXELS", max_pixels)
+        png = PNGImage(path)
+        spectrum = png.power_spectrum(tile_size=64, memory_budget=64 * 64 * 24)
+        self.assertTrue(np.array_equal(np.asarray(spectrum), expected))
+        pixels = png.greyscale_memmap(os.path.join(self._tmp_dir.name, "pixels.npy"), strip_rows=7)
+        self.assertTrue(np.array_equal(pixels, grey))
+        del pixels
+
+    def test_anonymize_file_removes_temporary_file_on_failure(self):
+        truncated = os.path.join(self._tmp_dir.name, "truncated.png")
+        with open(self.path, "rb") as file:
+            content = file.read()
+        with open(truncated, "wb") as file:
+            file.write(content[:len(content) // 2])
+        out_file = os.path.join(self._tmp_dir.name, "out.png")
+        with self.assertRaises(EOFError):
+            PNGImage.anonymize_file(truncated, out_file)
+        self.assertEqual(sorted(os.listdir(self._tmp_dir.name)), ["image.png", "truncated.png"])
+        PNGImage.anonymize_file(self.path, self.path)
+        self.assertTrue(np.array_equal(self._pixels(self.path), self._pixels(self._image("copy.png"))))
+
+
+if __name__ == '__main__':
+    unittest.main()
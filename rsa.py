@@ -1,19 +1,30 @@
 from Crypto.Util.number import getPrime, inverse
 from Crypto.PublicKey import RSA
-from Crypto.Cipher import AES, PKCS1_OAEP
+from Crypto.Cipher import PKCS1_OAEP
 import math
+import unittest
 
 
 class MyRSA:
+    padding_len = 3  # block padding: 1 zero byte + 2 bytes with number of zeros, must be >= 2
+    public_exponent = 65537
+
     def __init__(self, number_of_bits=1024, generate_keys=False):
+        self._mod, self._pub_exp, self._pvt_exp = None, None, None
+        self._crt = None
         if generate_keys:
-            self._mod, self._pub_exp, self._pvt_exp = self.generate_keys(number_of_bits)
+            self.set_keys(*self.generate_keys(number_of_bits))
         self._num_bits = number_of_bits
 
     @property
     def num_bytes(self):
         return self._num_bits // 8
 
+    @property
+    def block_size(self):
+        # max number of data bytes in one encrypted block
+        return self.num_bytes - MyRSA.padding_len
+
     @property
     def pub_exp(self):
         return self._pub_exp
@@ -30,43 +41,91 @@ class MyRSA:
     def keys(self):
         return self._mod, self._pub_exp, self.pvt_exp
 
-    def set_keys(self, mod, pub_exp, pvt_exp):
+    @property
+    def crt(self):
+        # (p, q, dP, dQ, qInv) or None if the modulus factors are unknown
+        return self._crt
+
+    def set_keys(self, mod, pub_exp, pvt_exp, p=None, q=None):
+        if p is None and (mod, pvt_exp) != (self._mod, self._pvt_exp):
+            self._crt = None
+        elif p is not None:
+            q = q if q is not None else mod // p
+            self._crt = p, q, pvt_exp % (p - 1), pvt_exp % (q - 1), inverse(q, p)
         self._mod, self._pub_exp, self._pvt_exp = mod, pub_exp, pvt_exp
 
     @staticmethod
     def generate_keys(number_of_bits=1024):
-        p = getPrime(number_of_bits // 2)
-        q = getPrime(number_of_bits // 2)
+        p = MyRSA.find_prime(number_of_bits // 2)
+        q = MyRSA.find_prime(number_of_bits // 2)
+        while q == p:
+            q = MyRSA.find_prime(number_of_bits // 2)
+        return MyRSA.keys_from_primes(p, q)
+
+    @staticmethod
+    def find_prime(number_of_bits):
+        # prime p usable with the fixed public exponent, e must not divide p - 1
+        p = getPrime(number_of_bits)
+        while (p - 1) % MyRSA.public_exponent == 0:
+            p = getPrime(number_of_bits)
+        return p
+
+    @staticmethod
+    def keys_from_primes(p, q):
         n = p * q
-        lcm = math.lcm(p-1, q-1)
-        e = MyRSA.random_coprime_below(lcm, number_of_bits // 2)
-        d = inverse(e, lcm)
-        return n, e, d
+        e = MyRSA.public_exponent
+        d = inverse(e, math.lcm(p - 1, q - 1))
+        return n, e, d, p, q
 
     def encrypt(self, value):
         return pow(value, self._pub_exp, self._mod)
 
     def decrypt(self, value):
-        return pow(value, self._pvt_exp, self._mod)
-
-    @staticmethod
-    def random_coprime_below(max_val, number_of_bits):
-        result = getPrime(number_of_bits)
-        while result >= max_val or math.gcd(result, max_val) != 1:
-            result = getPrime(number_of_bits)
-        return result
+        if self._crt is None:
+            return pow(value, self._pvt_exp, self._mod)
+        # chinese remainder theorem: two half size exponentiations instead of one full size
+        p, q, dp, dq, q_inv = self._crt
+        m1 = pow(value, dp, p)
+        m2 = pow(value, dq, q)
+        h = q_inv * (m1 - m2) % p
+        return m2 + h * q
+
+    def encrypt_block(self, data) -> bytes:
+        # block is padded as: number of zeros (2 bytes) + zeros + data, built directly as an integer
+        num_zeros = self.block_size - len(data)
+        value = num_zeros << (8 * self.block_size) | int.from_bytes(data, byteorder="big")
+        return self.encrypt(value).to_bytes(self.num_bytes, "big")
+
+    def decrypt_block(self, data) -> memoryview:
+        result = self.decrypt(int.from_bytes(data, byteorder="big")).to_bytes(self.num_bytes, "big")
+        num_zeros = int.from_bytes(result[MyRSA.padding_len - 2:MyRSA.padding_len], byteorder="big")
+        return memoryview(result)[MyRSA.padding_len + num_zeros:]
 
 
 class PyRSA:
     def __init__(self, number_of_bits=1024, generate_keys=False):
+        self._mod, self._pub_exp, self._pvt_exp = None, None, None
+        self._factors = None
+        self._cache = None
         if generate_keys:
-            self._mod, self._pub_exp, self._pvt_exp = self.generate_keys(number_of_bits)
+            self.set_keys(*self.generate_keys(number_of_bits))
         self._num_bits = number_of_bits
 
+    def __getstate__(self):
+        # cached PyCryptodome objects are rebuilt after unpickling (e.g. in worker processes)
+        state = self.__dict__.copy()
+        state["_cache"] = None
+        return state
+
     @property
     def num_bytes(self):
         return self._num_bits // 8
 
+    @property
+    def block_size(self):
+        # max number of data bytes in one OAEP block (SHA-1)
+        return self.num_bytes - 2 * 20 - 2
+
     @property
     def pub_exp(self):
         return self._pub_exp
@@ -83,20 +142,100 @@ class PyRSA:
     def keys(self):
         return self._mod, self._pub_exp, self.pvt_exp
 
-    def set_keys(self, mod, pub_exp, pvt_exp):
+    @property
+    def crt(self):
+        # (p, q, dP, dQ, qInv) or None if the modulus factors are unknown
+        if self._factors is None:
+            return None
+        key = self._key
+        return key.p, key.q, key.d % (key.p - 1), key.d % (key.q - 1), inverse(key.q, key.p)
+
+    def set_keys(self, mod, pub_exp, pvt_exp, p=None, q=None):
+        if (mod, pub_exp, pvt_exp) != (self._mod, self._pub_exp, self._pvt_exp):
+            self._cache = None
+            self._factors = None
+        if p is not None:
+            self._factors = p, q if q is not None else mod // p
+            self._cache = None
         self._mod, self._pub_exp, self._pvt_exp = mod, pub_exp, pvt_exp
 
+    @property
+    def _key(self):
+        return self._cached()[0]
+
+    def _cached(self):
+        # key, OAEP cipher and CRT exponents are built once per key set
+        if self._cache is None:
+            components = (self._mod, self._pub_exp, self._pvt_exp) + (self._factors or ())
+            key = RSA.construct(rsa_components=components)
+            self._factors = key.p, key.q
+            self._cache = key, PKCS1_OAEP.new(key), key.d % (key.p - 1), key.d % (key.q - 1)
+        return self._cache
+
     @staticmethod
     def generate_keys(number_of_bits=1024):
         key = RSA.generate(number_of_bits)
-        return key.n, key.e, key.d
+        return key.n, key.e, key.d, key.p, key.q
 
     def encrypt(self, value):
-        key = RSA.construct(rsa_components=(self._mod, self._pub_exp, self._pvt_exp))
-        cipher = PKCS1_OAEP.new(key)
-        return cipher.encrypt(bytearray(value))
+        return pow(value, self._pub_exp, self._mod)
 
     def decrypt(self, value):
-        key = RSA.construct(rsa_components=(self._mod, self._pub_exp, self._pvt_exp))
-        cipher = PKCS1_OAEP.new(key)
-        return cipher.decrypt(bytearray(value))
+        key, _, dp, dq = self._cached()
+        # u = p^-1 mod q
+        m1 = pow(value, dp, key.p)
+        m2 = pow(value, dq, key.q)
+        h = key.u * (m2 - m1) % key.q
+        return m1 + h * key.p
+
+    def encrypt_block(self, data) -> bytes:
+        return self._cached()[1].encrypt(data)
+
+    def decrypt_block(self, data) -> bytes:
+        return self._cached()[1].decrypt(data)
+
+
+class TestMyRSA(unittest.TestCase):
+    def test_crt_decrypt_matches_plain_decrypt(self):
+        rsa = MyRSA(1024, generate_keys=True)
+        plain = MyRSA(1024)
+        plain.set_keys(*rsa.keys)
+        for value in (0, 1, 2 ** 500 + 12345, rsa.mod - 1):
+            self.assertEqual(rsa.decrypt(rsa.encrypt(value)), value)
+            self.assertEqual(rsa.decrypt(value), plain.decrypt(value))
+
+    def test_set_keys_keeps_crt_for_same_key(self):
+        rsa = MyRSA(1024, generate_keys=True)
+        rsa.set_keys(*rsa.keys)
+        self.assertIsNotNone(rsa.crt)
+        rsa.set_keys(rsa.mod, rsa.pub_exp, rsa.pvt_exp + 1)
+        self.assertIsNone(rsa.crt)
+
+    def test_generated_keys(self):
+        n, e, d, p, q = MyRSA.generate_keys(1024)
+        self.assertEqual((n, e), (p * q, MyRSA.public_exponent))
+        self.assertEqual(e * d % math.lcm(p - 1, q - 1), 1)
+
+    def test_block_round_trip(self):
+        rsa = MyRSA(1024, generate_keys=True)
+        for data in (b"", b"\x00\x01", bytes(range(rsa.block_size))):
+            self.assertEqual(rsa.decrypt_block(rsa.encrypt_block(data)), data)
+
+
+class TestPyRSA(unittest.TestCase):
+    def test_raw_and_block_round_trip(self):
+        rsa = PyRSA(1024, generate_keys=True)
+        self.assertEqual(rsa.decrypt(rsa.encrypt(123456789)), 123456789)
+        data = bytes(range(rsa.block_size))
+        self.assertEqual(rsa.decrypt_block(rsa.encrypt_block(data)), data)
+
+    def test_set_keys_invalidates_cache(self):
+        rsa, other = PyRSA(1024, generate_keys=True), PyRSA(1024, generate_keys=True)
+        enc = other.encrypt_block(b"data")
+        rsa.encrypt_block(b"data")
+        rsa.set_keys(*other.keys)
+        self.assertEqual(rsa.decrypt_block(enc), b"data")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,243 @@
+import io
+import unittest
+import zlib
+
+import numpy as np
+from PIL import Image
+
+
+class ScanlineDecoder:
+    # png pixel data decoded strip by strip straight from the decompressed IDAT stream, so only one strip of
+    # scanlines is in memory whatever the image size, row filters are undone by PIL's png decoder (in C) and
+    # pixels converted with numpy
+    # adam7 passes: (first column, first row, column step, row step)
+    adam7 = ((0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4), (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2))
+    # for IHDR color type
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+    strip_bytes = 1 << 24  # max scanline bytes of one strip
+
+    def __init__(self, header, palette=None):
+        # header: IHDR payload, palette: (entries, 3) uint8 colors from PLTE (required for indexed color)
+        self.width = int.from_bytes(header[0:4], byteorder="big")
+        self.height = int.from_bytes(header[4:8], byteorder="big")
+        self.bit_depth, self.color_type, self.interlace = header[8], header[9], header[12]
+        if self.color_type not in ScanlineDecoder.channels or self.bit_depth not in (1, 2, 4, 8, 16):
+            raise ValueError(f"unsupported bit depth {self.bit_depth} of color type {self.color_type}")
+        self.bits_per_pixel = ScanlineDecoder.channels[self.color_type] * self.bit_depth
+        self._palette_grey = None
+        if self.color_type == 3:
+            if palette is None:
+                raise ValueError("indexed color image without palette")
+            self._palette_grey = np.zeros(256, np.uint8)  # indices past the palette are black
+            self._palette_grey[:min(len(palette), 256)] = ScanlineDecoder.luminance(palette[:256])
+
+    def passes(self):
+        # (first column, first row, column step, row step, width, height) of every pass having pixels
+        for col, row, col_step, row_step in ScanlineDecoder.adam7 if self.interlace else ((0, 0, 1, 1),):
+            width, height = -(-(self.width - col) // col_step), -(-(self.height - row) // row_step)
+            if width > 0 and height > 0:
+                yield col, row, col_step, row_step, width, height
+
+    def row_bytes(self, width):
+        return -(-width * self.bits_per_pixel // 8)
+
+    # writes pixels converted to greyscale (see greyscale) into out, an array of shape (height, width) such as
+    # np.memmap, pieces: decompressed IDAT data in pieces of any size
+    def fill_greyscale(self, out, pieces, strip_rows=256):
+        for (col, row, col_step, row_step, width, _), first_row, raw in self.raw_strips(pieces, strip_rows):
+            grey = self.greyscale(raw, width)
+            beg_row = row + first_row * row_step
+            out[beg_row: beg_row + len(grey) * row_step: row_step, col::col_step] = grey
+
+    # yields (pass, first row in pass, unfiltered scanlines as (rows, row bytes) uint8 array) for strips of at
+    # most strip_rows rows (fewer for very wide images)
+    def raw_strips(self, pieces, strip_rows=256):
+        pieces = iter(pieces)
+        buffer = bytearray()
+
+        def read(size):
+            while len(buffer) < size:
+                piece = next(pieces, None)
+                if piece is None:
+                    raise ValueError("IDAT data ends before the last scanline")
+                buffer.extend(piece)
+            data = bytes(buffer[:size])
+            del buffer[:size]
+            return data
+
+        # filters predict bytes from the byte one pixel back (at least one byte), sub-byte pixels are unfiltered
+        # as single bytes
+        classes = max(1, self.bits_per_pixel // 8)
+        for image_pass in self.passes():
+            row_bytes = self.row_bytes(image_pass[4])
+            rows = max(1, min(strip_rows, ScanlineDecoder.strip_bytes // (row_bytes + 1)))
+            previous = np.zeros(row_bytes, np.uint8)  # row above the first one of a pass is zeros
+            for first_row in range(0, image_pass[5], rows):
+                num_rows = min(rows, image_pass[5] - first_row)
+                filtered = np.frombuffer(read(num_rows * (row_bytes + 1)), np.uint8).reshape(num_rows, row_bytes + 1)
+                raw = ScanlineDecoder._unfilter(filtered, previous, classes)
+                previous = raw[-1]
+                yield image_pass, first_row, raw
+
+    @staticmethod
+    def _unfilter(filtered, previous, classes):
+        # a filtered byte depends only on bytes at the same position modulo classes (bytes per pixel), so every
+        # position is an independent image of 1 byte pixels: they are stacked into one 8 bit greyscale image,
+        # each preceded by its part of the previous scanline (as an unfiltered row), and unfiltered by PIL in one go
+        if np.any(filtered[:, 0] > 4):
+            raise ValueError("invalid scanline filter type")
+        num_rows, row_bytes = filtered.shape[0], filtered.shape[1] - 1
+        width = row_bytes // classes
+        stacked = np.empty((classes, num_rows + 1, width + 1), np.uint8)
+        stacked[:, 0, 0] = 0
+        stacked[:, 0, 1:] = previous.reshape(width, classes).T
+        stacked[:, 1:, 0] = filtered[:, 0]
+        stacked[:, 1:, 1:] = filtered[:, 1:].reshape(num_rows, width, classes).transpose(2, 0, 1)
+        image = Image.frombytes("L", (width, classes * (num_rows + 1)), zlib.compress(stacked.tobytes(), 0), "zip", "L")
+        unfiltered = np.asarray(image).reshape(classes, num_rows + 1, width)[:, 1:]
+        return np.ascontiguousarray(unfiltered.transpose(1, 2, 0)).reshape(num_rows, row_bytes)
+
+    def greyscale(self, raw, width):
+        # (rows, width) uint8 like PIL's convert("L") of the image: luminance of colors, alpha is dropped,
+        # samples of less than 8 bits are scaled to 0..255, 16 bit samples are reduced to their high byte
+        if self.bit_depth < 8:
+            bits = np.unpackbits(raw, axis=1)[:, :width * self.bit_depth].reshape(len(raw), width, self.bit_depth)
+            weights = (1 << np.arange(self.bit_depth - 1, -1, -1)).astype(np.uint8)
+            values = (bits * weights).sum(axis=-1, dtype=np.uint8)
+            if self.color_type == 3:
+                return self._palette_grey[values]
+            return values * np.uint8(255 // ((1 << self.bit_depth) - 1))
+        samples = raw.reshape(len(raw), width, -1)
+        if self.bit_depth == 16:
+            samples = samples[..., ::2]  # big endian, high bytes first
+        match self.color_type:
+            case 0 | 4:
+                return np.ascontiguousarray(samples[..., 0])
+            case 3:
+                return self._palette_grey[samples[..., 0]]
+            case _:
+                return ScanlineDecoder.luminance(samples[..., :3])
+
+    @staticmethod
+    def luminance(rgb):
+        # ITU-R 601-2 luma in fixed point, rounded the same way as PIL
+        rgb = rgb.astype(np.uint32)
+        return ((rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16).astype(np.uint8)
+
+
+class TestScanlineDecoder(unittest.TestCase):
+    @staticmethod
+    def _chunks(data):
+        # (IHDR payload, PLTE colors or None, decompressed IDAT data) of png data
+        idx, header, palette, idat = 8, None, None, []
+        while idx < len(data):
+            length = int.from_bytes(data[idx: idx + 4], byteorder="big")
+            name, payload = data[idx + 4: idx + 8], data[idx + 8: idx + 8 + length]
+            if name == b"IHDR":
+                header = payload
+            elif name == b"PLTE":
+                palette = np.frombuffer(payload, np.uint8).reshape(-1, 3)
+            elif name == b"IDAT":
+                idat.append(payload)
+            idx += 12 + length
+        return header, palette, zlib.decompress(b"".join(idat))
+
+    @staticmethod
+    def _header(width, height, bit_depth, color_type, interlace):
+        return width.to_bytes(4, "big") + height.to_bytes(4, "big") + bytes([bit_depth, color_type, 0, 0, interlace])
+
+    @staticmethod
+    def _png(header, scanlines):
+        def chunk(name, payload):
+            return len(payload).to_bytes(4, "big") + name + payload + zlib.crc32(name + payload).to_bytes(4, "big")
+        return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(scanlines))
+                + chunk(b"IEND", b""))
+
+    def _encode(self, values, bit_depth, color_type, interlace):
+        # png data of (height, width, channels) samples, scanlines are not filtered
+        header = self._header(values.shape[1], values.shape[0], bit_depth, color_type, interlace)
+        decoder = ScanlineDecoder(header)
+        scanlines = b""
+        for col, row, col_step, row_step, _, _ in decoder.passes():
+            samples = values[row::row_step, col::col_step].reshape(len(values[row::row_step]), -1)
+            if bit_depth == 16:
+                rows = samples.astype(">u2").view(np.uint8).reshape(len(samples), -1)
+            elif bit_depth == 8:
+                rows = samples.astype(np.uint8)
+            else:
+                bits = np.unpackbits(samples.astype(np.uint8)[..., np.newaxis], axis=-1)[..., 8 - bit_depth:]
+                rows = np.packbits(bits.reshape(len(samples), -1), axis=1)
+            for line in rows:
+                scanlines += b"\0" + line.tobytes()
+        return self._png(header, scanlines)
+
+    def _decode(self, data, strip_rows=5):
+        header, palette, idat = self._chunks(data)
+        decoder = ScanlineDecoder(header, palette)
+        out = np.full((decoder.height, decoder.width), 7, np.uint8)
+        # decompressed data arrives in uneven pieces
+        decoder.fill_greyscale(out, (idat[idx: idx + 1000] for idx in range(0, len(idat), 1000)), strip_rows)
+        return out
+
+    def _assert_like_pil(self, data, strip_rows=5):
+        with Image.open(io.BytesIO(data)) as image:
+            expected = np.asarray(image.convert("L"))
+        self.assertTrue(np.array_equal(self._decode(data, strip_rows), expected))
+
+    def test_matches_pil_for_filtered_images(self):
+        rng = np.random.default_rng(0)
+        gradient = np.add.outer(np.arange(37), np.arange(53)).astype(np.uint8)
+        noise = rng.integers(0, 256, (37, 53, 4), dtype=np.uint8)
+        images = [Image.fromarray(gradient + noise[..., 0] // 8, "L"),
+                  Image.fromarray((gradient[..., np.newaxis] + noise[..., :3] // 8).astype(np.uint8), "RGB"),
+                  Image.fromarray(noise, "RGBA"), Image.fromarray(noise[..., :2], "LA"),
+                  Image.fromarray(noise[..., 0] > 128)]
+        palette_image = Image.fromarray(noise[..., 0] % 16, "P")
+        palette_image.putpalette(rng.integers(0, 256, 48, dtype=np.uint8).tobytes())
+        for image, save_args in [(image, {}) for image in images] + [(palette_image, {}), (palette_image, {"bits": 4})]:
+            buffer = io.BytesIO()
+            image.save(buffer, "PNG", **save_args)
+            for strip_rows in (1, 5, 256):
+                self._assert_like_pil(buffer.getvalue(), strip_rows)
+
+    def test_interlaced_and_16_bit(self):
+        rng = np.random.default_rng(0)
+        for height, width in ((1, 1), (5, 3), (19, 23)):
+            rgb = rng.integers(0, 256, (height, width, 3))
+            for interlace in (0, 1):
+                self._assert_like_pil(self._encode(rgb, 8, 2, interlace))
+                self._assert_like_pil(self._encode(rgb[..., :1] % 2, 1, 0, interlace))
+                self._assert_like_pil(self._encode(rgb[..., :1] % 4, 2, 0, interlace))
+                self._assert_like_pil(self._encode(rgb * 257 + 3, 16, 2, interlace))
+                grey = rng.integers(0, 1 << 16, (height, width, 1))
+                self.assertTrue(np.array_equal(self._decode(self._encode(grey, 16, 0, interlace)), grey[..., 0] >> 8))
+
+    def test_random_filter_types(self):
+        # any bytes are valid filtered scanlines, so random ones with random filter types (all five of them)
+        # decode to the same pixels as PIL decodes them
+        rng = np.random.default_rng(0)
+        for bit_depth, color_type in ((8, 0), (8, 2), (8, 4), (8, 6), (16, 2), (16, 6), (4, 0), (2, 0)):
+            for interlace in (0, 1):
+                header = self._header(29, 17, bit_depth, color_type, interlace)
+                decoder, scanlines = ScanlineDecoder(header), b""
+                for pass_info in decoder.passes():
+                    row_bytes = decoder.row_bytes(pass_info[4])
+                    for _ in range(pass_info[5]):
+                        line = rng.integers(0, 256, row_bytes, dtype=np.uint8).tobytes()
+                        scanlines += bytes([rng.integers(0, 5)]) + line
+                self._assert_like_pil(self._png(header, scanlines), strip_rows=3)
+
+    def test_invalid_data(self):
+        data = self._encode(np.zeros((10, 10, 3), np.uint8), 8, 2, 0)
+        header, palette, idat = self._chunks(data)
+        out = np.empty((10, 10), np.uint8)
+        with self.assertRaises(ValueError):
+            ScanlineDecoder(header).fill_greyscale(out, [idat[:-1]])
+        with self.assertRaises(ValueError):
+            ScanlineDecoder(header).fill_greyscale(out, [b"\x05" + idat[1:]])
+        with self.assertRaises(ValueError):
+            ScanlineDecoder(header[:9] + b"\x03" + header[10:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class TaskRunner:
+    # runs one job at a time on a worker thread, results and progress are handed to tk from the main loop
+    # by polling with after, so callbacks never touch widgets from the worker thread
+    poll_ms = 50
+
+    def __init__(self, window, on_progress):
+        self.window = window
+        self.on_progress = on_progress  # on_progress(fraction) with fraction in [0, 1] or None if unknown
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="task_runner")
+        self._cancel = threading.Event()
+        self._future = None
+        self._progress = None
+        self._callbacks = None
+        self._cancellable = False
+
+    @property
+    def busy(self):
+        return self._future is not None
+
+    @property
+    def cancellable(self):
+        return self.busy and self._cancellable
+
+    def run(self, job, on_done=None, on_error=None, on_cancel=None, cancellable=True):
+        # job(progress) is called on the worker thread, it reports with progress(done, total)
+        # which raises TaskCancelled after cancel was requested, jobs with side effects should call it once more
+        # right before committing them, jobs never calling progress can not be stopped and should be run with
+        # cancellable=False
+        if self.busy:
+            return False
+        self._cancel.clear()
+        self._cancellable = cancellable
+        self._progress = None
+        self._callbacks = on_done, on_error, on_cancel
+        self._future = self._executor.submit(job, self._report)
+        self.window.after(TaskRunner.poll_ms, self._poll)
+        return True
+
+    def cancel(self):
+        if self.cancellable:
+            self._cancel.set()
+
+    def shutdown(self):
+        self._cancel.set()
+        self._executor.shutdown(wait=False)
+
+    def _report(self, done, total):
+        if self._cancel.is_set():
+            raise TaskCancelled()
+        self._progress = done / total if total else 1.0
+
+    def _poll(self):
+        if self._future is None:
+            return
+        self.on_progress(self._progress)
+        if not self._future.done():
+            self.window.after(TaskRunner.poll_ms, self._poll)
+            return
+        future, self._future = self._future, None
+        on_done, on_error, on_cancel = self._callbacks
+        self.on_progress(0.0)
+        try:
+            result = future.result()
+        except TaskCancelled:
+            if on_cancel is not None:
+                on_cancel()
+        except Exception as error:
+            if on_error is None:
+                raise
+            on_error(error)
+        else:
+            # a job finishing despite cancel has had its effects already, so it is done, not cancelled
+            if on_done is not None:
+                on_done(result)